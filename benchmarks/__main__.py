@@ -0,0 +1,28 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import sys
+
+from benchmarks.run import main
+
+sys.exit(main())
@@ -0,0 +1,195 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+"""
+Storage of benchmark baselines and detection of performance regressions.
+
+Baselines are kept per machine fingerprint (hardware and Python version)
+since results obtained on different machines can't be compared. A baseline
+holds the results of several runs of the benchmarks, a metric is considered
+to have regressed when the mean of new runs is worse than the baseline mean
+by more than both a relative tolerance and a number of standard deviations.
+Runs also record the options they were obtained with (e.g. --quick), only
+runs with the same options are compared.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import re
+import sys
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+# Metrics checked by default: events/s rates and memory per instance
+DEFAULT_GATED = r'(_per_sec|memory_per_instance)$'
+
+
+def machine_info():
+    """Returns a description of the machine the benchmarks run on."""
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = None
+    return {
+        'node': platform.node(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'system': platform.system(),
+        'cpus': cpus,
+        'implementation': platform.python_implementation(),
+        'python': '%s.%s' % sys.version_info[:2],
+    }
+
+
+def fingerprint(info=None):
+    """Returns a short identifier for the machine described by info."""
+    info = info or machine_info()
+    data = json.dumps(info, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+def baseline_path(baseline_dir=None, fprint=None):
+    """Returns the file name of the baseline for a machine fingerprint."""
+    return os.path.join(baseline_dir or BASELINE_DIR,
+                        '%s.json' % (fprint or fingerprint()))
+
+
+def save_baseline(runs, baseline_dir=None):
+    """Saves the runs (list of results from benchmarks.run.run) as the
+       baseline for the current machine. Returns the file name."""
+    path = baseline_path(baseline_dir)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump({'machine': machine_info(),
+                   'fingerprint': fingerprint(),
+                   'runs': runs}, f, indent=2, sort_keys=True)
+    return path
+
+
+def load_baseline(baseline_dir=None):
+    """Returns the baseline runs for the current machine, or None."""
+    path = baseline_path(baseline_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['runs']
+
+
+class OptionsMismatch(ValueError):
+    """Raised when comparing runs obtained with different options."""
+
+
+def run_options(run):
+    """Returns the options (see benchmarks.run.Options) of a run, None
+       for options that weren't recorded."""
+    options = {'quick': run.get('quick'), 'max_instances': None}
+    options.update(run.get('options', {}))
+    return options
+
+
+def higher_is_better(metric):
+    """Returns True for metrics that are rates, False for durations and
+       memory footprints."""
+    return metric.endswith('_per_sec')
+
+
+def _stats(values):
+    """Returns the mean and (sample) standard deviation of values."""
+    mean = sum(values) / float(len(values))
+    if len(values) < 2:
+        return mean, 0.
+    var = sum((v - mean) ** 2 for v in values) / (len(values) - 1)
+    return mean, math.sqrt(var)
+
+
+def _samples(runs):
+    """Returns {(benchmark, metric): [values]} for a list of runs."""
+    samples = {}
+    for run in runs:
+        for name, metrics in run['benchmarks'].items():
+            for metric, value in metrics.items():
+                samples.setdefault((name, metric), []).append(value)
+    return samples
+
+
+class Comparison(object):
+    """Result of comparing a metric with its baseline."""
+
+    def __init__(self, name, metric, base, new, tolerance, sigmas):
+        self.name = name
+        self.metric = metric
+        self.base_mean, self.base_std = _stats(base)
+        self.new_mean, self.new_std = _stats(new)
+        # Positive change is an improvement
+        sign = 1 if higher_is_better(metric) else -1
+        self.change = sign * (self.new_mean - self.base_mean) / \
+            (abs(self.base_mean) or 1.)
+        noise = sigmas * math.sqrt(self.base_std ** 2 + self.new_std ** 2)
+        self.regressed = (self.change < -tolerance and
+                          sign * (self.new_mean - self.base_mean) < -noise)
+
+    def __str__(self):
+        return '%-20s %-28s %12.6g -> %12.6g  %+7.1f%%%s' % (
+            self.name, self.metric, self.base_mean, self.new_mean,
+            100 * self.change, '  REGRESSION' if self.regressed else '')
+
+
+def compare(base_runs, new_runs, tolerance=.1, sigmas=3., gated=DEFAULT_GATED):
+    """Compares the metrics of new_runs with those of base_runs.
+
+       Args:
+           tolerance: relative degradation tolerated for a metric.
+           sigmas:    number of standard deviations (of the difference
+                      between baseline and new results) a degradation must
+                      exceed to be considered significant.
+           gated:     regular expression selecting the metrics that
+                      are checked.
+       Returns:
+           A list of Comparisons for the checked metrics present in both
+           the baseline and the new runs.
+       Raises:
+           OptionsMismatch if the runs weren't all obtained with the
+           same options.
+    """
+    options = set(json.dumps(run_options(r), sort_keys=True)
+                  for r in list(base_runs) + list(new_runs))
+    if len(options) > 1:
+        raise OptionsMismatch(
+            'runs obtained with different options (%s), re-run with the '
+            'options of the baseline or save a new baseline' %
+            ' vs '.join(sorted(options)))
+    base, new = _samples(base_runs), _samples(new_runs)
+    gated = re.compile(gated)
+    return [Comparison(name, metric, base[(name, metric)], values,
+                       tolerance, sigmas)
+            for ((name, metric), values) in sorted(new.items())
+            if (name, metric) in base and gated.search(metric)]
+
+# vim:expandtab:sw=4:sts=4
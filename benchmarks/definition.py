@@ -0,0 +1,150 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+"""Benchmarks of StateMachine class definition (SMMeta) and of the
+   import of toysm."""
+
+import os
+import subprocess
+import sys
+import time
+
+import toysm
+from toysm import State, InitialState, StateMachine
+from toysm.base_sm import SMMeta, create_copy_context, mask_states
+
+from benchmarks.run import benchmark
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def make_sm_class(name, n, base=StateMachine):
+    """Returns a StateMachine subclass with n states connected in a ring."""
+    dct = {'s%i' % i: State() for i in range(n)}
+    states = [dct['s%i' % i] for i in range(n)]
+    for a, b in zip(states, states[1:] + states[:1]):
+        a >> 'n' >> b
+    dct['init'] = InitialState()
+    dct['init'] >> states[0]
+    dct['__module__'] = __name__
+    return SMMeta(name, (base,), dct)
+
+
+@benchmark
+def class_definition(options):
+    """Time (ms) to define StateMachine classes with 10 to 500 states,
+       subclasses of these adding a state (which copy the base's graph)
+       or sharing the base's graph, and compositions using as_state()."""
+    res = {}
+    repeat = 5 if options.quick else 20
+    for n in (10, 100, 500):
+        t0 = timer()
+        for i in range(repeat):
+            base = make_sm_class('Base%i' % n, n)
+        t1 = timer()
+        for i in range(repeat):
+            SMMeta('Sub%i' % n, (base,),
+                   {'__module__': __name__, 'extra': State()})
+        t2 = timer()
+        for i in range(repeat):
+            base.as_state()
+        t3 = timer()
+        for i in range(repeat):
+            SMMeta('Shared%i' % n, (base,), {'__module__': __name__})
+        t4 = timer()
+        res['n%i_class_ms' % n] = (t1 - t0) * 1e3 / repeat
+        res['n%i_subclass_ms' % n] = (t2 - t1) * 1e3 / repeat
+        res['n%i_as_state_ms' % n] = (t3 - t2) * 1e3 / repeat
+        res['n%i_shared_subclass_ms' % n] = (t4 - t3) * 1e3 / repeat
+    return res
+
+
+@benchmark
+def class_hierarchy(options):
+    """Time (ms) to define a hierarchy of 80 StateMachine subclasses of a
+       base class with 300 states, each masking a state of its parent and
+       adding a transition to one of the inherited states."""
+    n, depth = 300, 20 if options.quick else 80
+    t0 = timer()
+    base = make_sm_class('Base', n)
+    t1 = timer()
+    cls = base
+    for i in range(depth):
+        with_extra = {'__module__': __name__}
+        if i:
+            create_copy_context()
+            mask_states('x%i' % (i - 1))
+        state = with_extra['x%i' % i] = State()
+        cls.get_state('s%i' % (i % n)) >> 'x' >> state
+        cls = SMMeta('Sub%i' % i, (cls,), with_extra)
+    t2 = timer()
+    return {'base_ms': (t1 - t0) * 1e3,
+            'subclass_ms': (t2 - t1) * 1e3 / depth,
+            'hierarchy_ms': (t2 - t0) * 1e3}
+
+
+def _run_python(code, *flags):
+    """Runs code in a fresh interpreter that can import toysm, returns
+       (wall time in seconds, stdout, stderr)."""
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(toysm.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+    t0 = timer()
+    proc = subprocess.Popen([sys.executable] + list(flags) + ['-c', code],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=env, universal_newlines=True)
+    out, err = proc.communicate()
+    t1 = timer()
+    if proc.returncode:
+        raise RuntimeError('python -c %r failed:\n%s' % (code, err))
+    return t1 - t0, out, err
+
+
+@benchmark
+def import_time(options):
+    """Time (ms) to import toysm in a fresh interpreter (best of 5/20
+       runs, less the startup time of the interpreter), time reported
+       by python -X importtime (Python 3.7+) and number of modules the
+       import loads."""
+    repeat = 5 if options.quick else 20
+    res = {}
+    startup = min(_run_python('pass')[0] for _ in range(repeat))
+    res['import_ms'] = max(0., min(_run_python('import toysm')[0]
+                                   for _ in range(repeat)) - startup) * 1e3
+    _, out, _ = _run_python('import sys; n = len(sys.modules); '
+                            'import toysm; print(len(sys.modules) - n)')
+    res['modules'] = int(out)
+    if sys.version_info >= (3, 7):
+        cumulative = []
+        for _ in range(repeat):
+            _, _, err = _run_python('import toysm', '-X', 'importtime')
+            for line in err.splitlines():
+                # import time: self [us] | cumulative | imported package
+                fields = line.split('|')
+                if len(fields) == 3 and fields[2].strip() == 'toysm':
+                    cumulative.append(int(fields[1]))
+        res['importtime_ms'] = min(cumulative) / 1e3
+    return res
+
+# vim:expandtab:sw=4:sts=4
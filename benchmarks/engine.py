@@ -0,0 +1,284 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+"""Benchmarks of the StateMachine event processing engine."""
+
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from toysm import State, ParallelState, DeepHistoryState, FinalState, \
+    EqualsTransition, Timeout, StateMachine
+
+from benchmarks.run import benchmark, settle, percentiles
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def _throughput(sm, evts):
+    """Returns the rate at which sm processes evts."""
+    sm.start()
+    settle(sm)
+    t0 = timer()
+    sm.post(*evts)
+    settle(sm)
+    dt = timer() - t0
+    sm.stop()
+    sm.join(1)
+    return {'events': len(evts), 'events_per_sec': len(evts) / dt}
+
+
+def _ring(n, evt, parent=None):
+    """Returns n states connected in a ring by evt transitions."""
+    states = [State('s%i' % i, parent=parent, initial=parent and i == 0)
+              for i in range(n)]
+    for a, b in zip(states, states[1:] + states[:1]):
+        a >> evt >> b
+    return states
+
+
+def _chain(root, depth, name):
+    """Returns the leaf of a chain of depth nested states under root."""
+    state = root
+    for i in range(depth):
+        state = State('%s%i' % (name, i), parent=state,
+                      initial=not state.children)
+    return state
+
+
+@benchmark
+def post_latency(options):
+    """Time between posting an event and the end of its transition action."""
+    done = threading.Event()
+
+    def action(sm, evt):
+        done.set()
+
+    s1, s2 = State('s1'), State('s2')
+    sm = StateMachine(s1 >> EqualsTransition('a', action=action) >> s2
+                      >> EqualsTransition('b', action=action) >> s1)
+    sm.start()
+    settle(sm)
+    latencies = []
+    for i in range(options.scale(2000)):
+        done.clear()
+        t0 = timer()
+        sm.post('b' if i % 2 else 'a')
+        done.wait()
+        latencies.append((timer() - t0) * 1e6)
+    sm.stop()
+    sm.join(1)
+    return {'latency_%s_us' % k: v for (k, v) in
+            percentiles(latencies).items()}
+
+
+@benchmark
+def flat_throughput(options):
+    """Events/s for a flat machine of 10 states connected in a ring."""
+    root = State('root')
+    _ring(10, 'n', parent=root)
+    return _throughput(StateMachine(root), ['n'] * options.scale(50000))
+
+
+@benchmark
+def deep_throughput(options):
+    """Events/s for transitions between the leaves of two chains of
+       20 nested states (each event exits and enters 20 states)."""
+    root = State('root')
+    a = _chain(root, 20, 'a')
+    b = _chain(root, 20, 'b')
+    a >> 'x' >> b >> 'x' >> a
+    return _throughput(StateMachine(root), ['x'] * options.scale(10000))
+
+
+@benchmark
+def wide_throughput(options):
+    """Events/s for a ParallelState with 50 regions, each event causes
+       a transition in every region."""
+    p = ParallelState('p')
+    for i in range(50):
+        _ring(2, 'x', parent=State('r%i' % i, parent=p))
+    return _throughput(StateMachine(p), ['x'] * options.scale(2000))
+
+
+@benchmark
+def sparse_throughput(options):
+    """Events/s for a ParallelState with 50 regions, each reacting to its
+       own event, events only cause a transition in one region."""
+    p = ParallelState('p')
+    for i in range(50):
+        _ring(2, 'x%i' % i, parent=State('r%i' % i, parent=p))
+    return _throughput(StateMachine(p), ['x0'] * options.scale(10000))
+
+
+@benchmark
+def timeout_throughput(options):
+    """Events/s for states that schedule and cancel Timeouts on each
+       entry/exit."""
+    s1, s2, s3 = State('s1'), State('s2'), State('s3')
+    s1 >> 'a' >> s2 >> 'b' >> s1
+    s1 >> Timeout(3600) >> s3
+    s2 >> Timeout(3600) >> s3
+    return _throughput(StateMachine(s1, s2, s3),
+                       ['a', 'b'] * options.scale(10000))
+
+
+@benchmark
+def completion_chain(options):
+    """Events/s when each event triggers a chain of 10 completion
+       transitions."""
+    states = [State('s%i' % i) for i in range(11)]
+    for a, b in zip(states, states[1:]):
+        a >> b
+    states[-1] >> 'x' >> states[0]
+    res = _throughput(StateMachine(*states), ['x'] * options.scale(5000))
+    return {'events_per_sec': res['events_per_sec'],
+            'completions_per_sec': res['events_per_sec'] * 10}
+
+
+@benchmark
+def deep_history(options):
+    """Save/restore cycles/s for a DeepHistoryState in a 5 level deep
+       composite state."""
+    s = State('s')
+    leaf = _chain(s, 5, 'c')
+    history = DeepHistoryState(parent=s)
+    leaf >> 'x' >> State('alt', parent=leaf.parent) >> 'x' >> leaf
+    out = State('out')
+    s >> 'out' >> out >> 'in' >> history
+    n = options.scale(5000)
+    res = _throughput(StateMachine(s, out), ['x', 'out', 'in'] * n)
+    return {'cycles_per_sec': res['events_per_sec'] / 3}
+
+
+@benchmark
+def do_activity_throughput(options):
+    """Events/s for states with a do-activity, each event exits one and
+       enters another, with a Thread per do-activity or a shared executor."""
+    res = {}
+    for name, executor in (('thread', None), ('executor', 4)):
+        s1 = State('s1', do=lambda sm, state, ex_req: ex_req.wait(1))
+        s2 = State('s2', do=lambda sm, state, ex_req: ex_req.wait(1))
+        s1 >> 'x' >> s2 >> 'x' >> s1
+        sm = StateMachine(s1, s2, executor=executor)
+        res['%s_events_per_sec' % name] = \
+            _throughput(sm, ['x'] * options.scale(2000))['events_per_sec']
+    return res
+
+
+def _demux_sm():
+    """Returns a simple StateMachine with one instance per event key."""
+    s1, s2 = State('s1'), State('s2')
+    return StateMachine(s1 >> 'a' >> s2 >> 'b' >> s1,
+                        demux=lambda evt: evt)
+
+
+@benchmark
+def instance_creation(options):
+    """Demux instances created/s for a machine whose initial configuration
+       has 5 nested states and a ParallelState with 4 regions, with and
+       without the initial configuration template."""
+    res = {}
+    n = options.scale(20000)
+    for name, pure_init in (('template', None), ('no_template', False)):
+        root = State('root')
+        p = ParallelState('p', parent=_chain(root, 5, 'c'), initial=True)
+        for i in range(4):
+            _ring(2, 'x', parent=State('r%i' % i, parent=p))
+        sm = StateMachine(root, demux=lambda evt: evt, pure_init=pure_init)
+        sm.start()
+        t0 = timer()
+        sm.post(*[(k, 'a') for k in range(n)])
+        settle(sm)
+        res['%s_create_per_sec' % name] = n / (timer() - t0)
+        sm.stop()
+        sm.join(1)
+    return res
+
+
+@benchmark
+def instance_churn(options):
+    """Short-lived demux instances (created, one transition, terminated)
+       per second, with and without reuse of terminated instances."""
+    res = {}
+    n = options.scale(50000)
+    for name, pool_size in (('pool', 1000), ('no_pool', 0)):
+        r = State('r')
+        _ring(3, 'x', parent=r)
+        sm = StateMachine(r >> 'end' >> FinalState(),
+                          demux=lambda evt: evt, pool_size=pool_size)
+        sm.start()
+        t0 = timer()
+        for i in range(0, n, 1000):
+            sm.post(*[(k, e) for k in range(i, i + 1000)
+                      for e in ('x', 'end')])
+        settle(sm)
+        res['%s_instances_per_sec' % name] = n / (timer() - t0)
+        sm.stop()
+        sm.join(1)
+    return res
+
+
+@benchmark
+def demux_scaling(options):
+    """Instance creation and event rate with 1 to max_instances demux
+       instances."""
+    res = {}
+    n = 1
+    max_n = min(options.max_instances, 1000) if options.quick \
+        else options.max_instances
+    while n <= max_n:
+        sm = _demux_sm()
+        sm.start()
+        t0 = timer()
+        sm.post(*[(k, 'a') for k in range(n)])
+        settle(sm)
+        t1 = timer()
+        sm.post(*[(k, 'b') for k in range(n)])
+        settle(sm)
+        t2 = timer()
+        sm.stop()
+        sm.join(1)
+        res['n%i_create_per_sec' % n] = n / (t1 - t0)
+        res['n%i_events_per_sec' % n] = n / (t2 - t1)
+        n *= 10
+    if tracemalloc is not None:
+        count = min(max_n, 10000)
+        sm = _demux_sm()
+        sm.start()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        sm.post(*[(k, 'a') for k in range(count)])
+        settle(sm)
+        res['memory_per_instance'] = \
+            float(tracemalloc.get_traced_memory()[0] - before) / count
+        tracemalloc.stop()
+        sm.stop()
+        sm.join(1)
+    return res
+
+# vim:expandtab:sw=4:sts=4
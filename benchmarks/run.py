@@ -0,0 +1,215 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+"""
+Benchmark registry and command line runner.
+
+Benchmarks are functions decorated with @benchmark, they are called with
+the Options of the run and return a dict of metric name -> value.
+
+The runner can also save the results as a baseline for the current machine
+(--save-baseline) and compare new results against it (--check), in which
+case the exit status is 1 if a regression was detected (see
+benchmarks.baseline).
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import toysm
+
+from benchmarks import baseline
+
+# name -> benchmark function, in order of registration
+BENCHMARKS = {}
+_ORDER = []
+
+
+def benchmark(fn):
+    """Registers fn as a benchmark."""
+    BENCHMARKS[fn.__name__] = fn
+    _ORDER.append(fn.__name__)
+    return fn
+
+
+class Options(object):
+    """Parameters shared by all benchmarks."""
+
+    def __init__(self, quick=False, max_instances=10 ** 5):
+        self.quick = quick
+        self.max_instances = max_instances
+
+    def as_dict(self):
+        """Returns the options, as recorded in results (results obtained
+           with different options can't be compared)."""
+        return {'quick': self.quick, 'max_instances': self.max_instances}
+
+    def scale(self, n):
+        """Returns the number of iterations to use for a nominal count of n."""
+        return max(1, n // 20) if self.quick else n
+
+
+def settle(sm, timeout=60.):
+    """Waits for sm to process all posted events."""
+    t_max = time.time() + timeout
+    while not sm.settle(1):
+        if time.time() > t_max:
+            raise RuntimeError('%s failed to settle' % sm)
+
+
+def percentiles(values, pcts=(50, 90, 99)):
+    """Returns a dict of the pcts percentiles of values."""
+    values = sorted(values)
+    return {'p%i' % p: values[min(len(values) - 1, len(values) * p // 100)]
+            for p in pcts}
+
+
+def load():
+    """Imports the modules defining benchmarks."""
+    # pylint: disable=unused-import
+    import benchmarks.engine
+    import benchmarks.definition
+
+
+def run(names=None, options=None):
+    """Runs the benchmarks designated by names (all by default).
+       Returns a dict suitable for JSON serialization."""
+    load()
+    options = options or Options()
+    names = names or _ORDER
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError('Unknown benchmark(s): %s' % ', '.join(sorted(unknown)))
+    results = {}
+    for name in names:
+        t0 = time.time()
+        results[name] = BENCHMARKS[name](options)
+        results[name]['wall_time'] = time.time() - t0
+    return {
+        'toysm': toysm.__version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'quick': options.quick,
+        'options': options.as_dict(),
+        'time': time.time(),
+        'benchmarks': results,
+    }
+
+
+def format_results(results, stream=sys.stdout):
+    """Prints results in a human readable form."""
+    for name, metrics in sorted(results['benchmarks'].items()):
+        print(name, file=stream)
+        for metric, value in sorted(metrics.items()):
+            print('    %-32s %14.6g' % (metric, value), file=stream)
+
+
+def parse_args(argv, parser=None):
+    """Parses the arguments of the benchmark command line."""
+    parser = parser or argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Run the ToySM performance benchmarks.')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--quick', action='store_true',
+                        help='reduce iteration counts (smoke test)')
+    parser.add_argument('--max-instances', type=int, default=10 ** 5,
+                        help='largest number of demux instances (default: '
+                             '%(default)s)')
+    parser.add_argument('--json', metavar='FILE',
+                        help="write results to FILE as JSON ('-' for stdout)")
+    parser.add_argument('--list', action='store_true',
+                        help='list available benchmarks')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of runs of the benchmarks (default: '
+                             '%(default)s, use more with --save-baseline '
+                             'and --check)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save results as the baseline for this machine')
+    parser.add_argument('--check', action='store_true',
+                        help='compare results with the baseline for this '
+                             'machine, exit status is 1 on regression')
+    parser.add_argument('--baseline-dir', metavar='DIR',
+                        help='directory holding baselines (default: '
+                             'benchmarks/baselines)')
+    parser.add_argument('--tolerance', type=float, default=.1,
+                        help='relative degradation tolerated by --check '
+                             '(default: %(default)s)')
+    parser.add_argument('--sigmas', type=float, default=3.,
+                        help='standard deviations a degradation must exceed '
+                             'to be reported by --check (default: '
+                             '%(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Entry point of python -m benchmarks."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.list:
+        load()
+        print('\n'.join(_ORDER))
+        return 0
+    options = Options(quick=args.quick, max_instances=args.max_instances)
+    runs = [run(args.names, options) for _ in range(max(1, args.repeat))]
+    results = runs[-1] if len(runs) == 1 else {'runs': runs}
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        for r in runs:
+            format_results(r)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    status = 0
+    if args.check:
+        base_runs = baseline.load_baseline(args.baseline_dir)
+        if base_runs is None:
+            print('No baseline for this machine (%s), use --save-baseline' %
+                  baseline.baseline_path(args.baseline_dir), file=sys.stderr)
+            status = 2
+        else:
+            try:
+                comparisons = baseline.compare(base_runs, runs,
+                                               tolerance=args.tolerance,
+                                               sigmas=args.sigmas)
+            except baseline.OptionsMismatch as exc:
+                print('Results not compared: %s' % exc, file=sys.stderr)
+                status = 2
+            else:
+                for comparison in comparisons:
+                    print(comparison, file=sys.stderr)
+                if any(c.regressed for c in comparisons):
+                    status = 1
+    if args.save_baseline:
+        print('Baseline saved to %s' %
+              baseline.save_baseline(runs, args.baseline_dir),
+              file=sys.stderr)
+    return status
+
+# vim:expandtab:sw=4:sts=4
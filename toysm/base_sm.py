@@ -31,10 +31,9 @@ classes.
 import sys
 import copy
 import threading
-from six import with_metaclass
-
 from toysm.public import public
-from toysm.core import Transition, State, InitialState, IllFormedException
+from toysm.core import Transition, State, InitialState, IllFormedException, \
+    _ordered, with_metaclass
 
 
 @public
@@ -228,6 +227,8 @@ class SMCopyContext(object):
         self.copy_map = {}
         self.masked_states = set()
         self.masked_transitions = set()
+        # cls -> (masked States, masked Transitions), see _get_masked
+        self.masked = {}
 
 
 def _get_masked(copy_ctx, cls):
@@ -235,6 +236,8 @@ def _get_masked(copy_ctx, cls):
     Returns the set of masked State/Transition objects for cls.
 
     The State/Transition objects are those declared/referenced by cls.
+    They are resolved once per copy context and class, masks can't
+    change once copies have been made in the context (see mask_states).
 
     Args:
         copy_ctx: _SMCopyContext source of the string names of the
@@ -242,8 +245,11 @@ def _get_masked(copy_ctx, cls):
         cls:      Class in which to lookup the masked State/Transitions.
 
     Returns:
-
+        A (masked_states, masked_transitions) tuple of sets.
     """
+    masked = copy_ctx.masked.get(cls)
+    if masked is not None:
+        return masked
     if cls is None:
         masked_states = set()
         masked_transitions = set()
@@ -260,7 +266,8 @@ def _get_masked(copy_ctx, cls):
         masked_transitions = {cls._transitions[t]
                               for t in filter_mask(copy_ctx.masked_transitions)
                               if t in cls._transitions}
-    return masked_states, masked_transitions
+    copy_ctx.masked[cls] = masked = masked_states, masked_transitions
+    return masked
 
 
 def _sm_copy(state, copy_ctx, cls=None):
@@ -300,7 +307,33 @@ def _sm_copy(state, copy_ctx, cls=None):
     masked_states, masked_transitions = _get_masked(copy_ctx, cls)
     if state in masked_states:
         return
-    copy_map[state] = s_copy = copy.copy(state)
+    # Depth first traversal of the graph, the stack holds the
+    # _copy_relations generators of the States being copied.
+    stack = []
+    pending = state
+    while True:
+        if pending is not None and pending not in copy_map:
+            copy_map[pending] = s_copy = copy.copy(pending)
+            stack.append(_copy_relations(pending, s_copy, copy_map,
+                                         masked_states, masked_transitions))
+        try:
+            pending = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            if not stack:
+                return copy_map[state]
+            pending = None
+
+
+def _copy_relations(state, s_copy, copy_map, masked_states,
+                    masked_transitions):
+    """
+    Connects s_copy, the copy of state, to copies of its transitions,
+    their targets and its children.
+
+    Yields the States that must be copied before their copy can be
+    connected to s_copy, see _sm_copy.
+    """
     for trans in state.transitions:
         if trans.target in masked_states or trans in masked_transitions:
             continue
@@ -309,19 +342,18 @@ def _sm_copy(state, copy_ctx, cls=None):
             trans_copy = copy.copy(trans)
             s_copy.add_transition(trans_copy)
             if trans.target is not None:
-                t_copy = _sm_copy(trans.target, copy_ctx, cls)
-                t_copy.accept_transition(trans_copy)
+                yield trans.target
+                copy_map[trans.target].accept_transition(trans_copy)
             copy_map[trans] = trans_copy
 
-    # Recursively copy children. The parent isn't copied,
-    # it is therefore up to a copied parent to connect
-    # with the copied children.
-    for c in state.children:    # pylint: disable=invalid-name
+    # Copy children (in creation order so that copies are created in
+    # the same order). The parent isn't copied, it is therefore up
+    # to a copied parent to connect with the copied children.
+    for c in _ordered(state.children):    # pylint: disable=invalid-name
         if c in masked_states:
             continue
-        c_copy = _sm_copy(c, copy_ctx, cls)
-        c_copy.set_parent(s_copy, initial=c is state.initial)
-    return s_copy
+        yield c
+        copy_map[c].set_parent(s_copy, initial=c is state.initial)
 
 
 ################################################################################
@@ -344,22 +376,35 @@ def _find_reachable(states, reachable=None):
     """
     if reachable is None:
         reachable = set()
-    for s in states:    # pylint: disable=invalid-name
+    stack = list(states)
+    while stack:
+        s = stack.pop()    # pylint: disable=invalid-name
         if s in reachable:
             continue
         reachable.add(s)
-        _find_reachable([t.target for t in s.transitions
-                         if t.target is not None], reachable)
-        _find_reachable([t.source for t in s.rev_transitions], reachable)
-        _find_reachable(s.children, reachable)
+        stack.extend(t.target for t in s.transitions if t.target is not None)
+        stack.extend(t.source for t in s.rev_transitions)
+        stack.extend(s.children)
         if s.parent is not None:
-            _find_reachable([s.parent], reachable)
+            stack.append(s.parent)
     return reachable
 
 
 ################################################################################
 # Base classes for StateMachines
 
+def _freeze_graph(root):
+    """Freezes the States and Transitions of the graph under root, see
+       State.freeze."""
+    states = [root]
+    while states:
+        state = states.pop()
+        state.freeze()
+        for t in state.transitions:
+            t.freeze()
+        states.extend(state.children)
+
+
 class SMMeta(type):
     """
     Meta class that provides the StateMachine inheritance behavior.
@@ -396,15 +441,28 @@ class SMMeta(type):
         #   they haven't been named explicitly)
 
         ctx = _COPY_CONTEXT_STACK.pop_ctx()
+        sm_bases = [b for b in bases
+                    if hasattr(b, '_states') or hasattr(b, '_transitions')]
+        if len(sm_bases) == 1 and not (ctx.copy_map or ctx.masked_states or
+                                       ctx.masked_transitions) \
+                and not any(isinstance(v, (State, Transition))
+                            for v in dct.values()):
+            # The class doesn't reference, mask or add States/Transitions,
+            # its graph would be an identical copy of its base's graph.
+            # The base's graph is therefore shared by inheriting _states,
+            # _transitions and _cstate. It is frozen so that neither class
+            # can modify it (hooks that only apply to a StateMachine are
+            # registered with it, see StateMachine.add_state_hook);
+            # subclasses and compositions work on (unfrozen) copies.
+            _freeze_graph(sm_bases[0]._cstate)
+            return type.__new__(mcs, name, bases, dct)
         states = {}
         transitions = {}
         unknown_masked_states = {s for s in ctx.masked_states if '.' not in s}
         unknown_masked_transitions = {t for t in ctx.masked_transitions
                                       if '.' not in t}
         copied_initial = False
-        for b in bases: # pylint: disable=invalid-name
-            if not (hasattr(b, '_states') or hasattr(b, '_transitions')):
-                continue
+        for b in sm_bases: # pylint: disable=invalid-name
             # copy the first non-masked base class initial state
             if not copied_initial:
                 if not b._auto_cstate:
@@ -0,0 +1,179 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# pylint: disable=protected-access
+
+"""
+Export of StateMachine activity in the Chrome trace-event format.
+
+The resulting file can be loaded in chrome://tracing or Perfetto to show
+state residency and transition action durations on a timeline:
+- each SM instance (see the 'demux' argument of StateMachine) is shown
+  as a process,
+- states are shown as slices nested within the slices of their
+  parent states; the content of each ParallelRegion has its own thread
+  so that orthogonal regions don't overlap,
+- transition actions are shown as slices named after the transition.
+"""
+
+import json
+from threading import Lock
+import time
+
+from toysm.core import ParallelRegion, PseudoState
+from toysm.public import public
+
+
+@public
+class ChromeTrace(object):
+    """Streams StateMachine activity to a Chrome trace-event JSON file.
+
+       trace = ChromeTrace('sm.json').attach(sm)
+       ...
+       trace.close()
+    """
+
+    def __init__(self, out, buffer_size=512, clock=time.time):
+        """
+        Parameters:
+        out          file name or file-like object the trace is written to.
+
+        buffer_size  number of trace events buffered before they are
+                     written out.
+
+        clock        function returning the current time (in seconds).
+        """
+        if hasattr(out, 'write'):
+            self._stream, self._own_stream = out, False
+        else:
+            self._stream, self._own_stream = open(out, 'w'), True
+        self.buffer_size = buffer_size
+        self.clock = clock
+        self._t0 = clock()
+        self._lock = Lock()
+        self._buffer = ['[\n']
+        self._sep = ''
+        self._pids = {}         # SM instance key -> pid
+        self._tids = {}         # State -> tid
+        self._begin = {}        # (pid, State/Transition) -> start time
+
+    def attach(self, sm):
+        """Start tracing all States/Transitions of sm (other StateMachines
+           sharing its State graph aren't traced, see
+           StateMachine.add_state_hook). Returns the ChromeTrace."""
+        self._tids[sm._cstate] = 0
+        states = [sm._cstate]
+        while states:
+            state = states.pop()
+            tid = self._tids[state]
+            if not isinstance(state, PseudoState):
+                sm.add_state_hook(state, 'pre_entry', self._begin_slice)
+                sm.add_state_hook(state, 'post_exit', self._end_slice,
+                                  'state', tid)
+            for t in state.transitions:
+                sm.add_transition_hook(t, self._begin_action)
+                sm.add_transition_post_hook(t, self._end_action, tid)
+            for c in state.children:
+                self._tids[c] = len(self._tids) \
+                    if isinstance(c, ParallelRegion) else tid
+                states.append(c)
+        return self
+
+    def _ts(self, t):
+        """Converts a clock value to a trace timestamp (us)."""
+        return (t - self._t0) * 1e6
+
+    def _get_pid(self, key):
+        """Returns the pid for the SM instance with the given key."""
+        pid = self._pids.get(key)
+        if pid is None:
+            pid = self._pids[key] = len(self._pids) + 1
+            self._emit({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                        'args': {'name': 'SM key=%r' % (key,)}})
+        return pid
+
+    def _begin_slice(self, sm, elt, *_):
+        """Hook called when a State is entered."""
+        self._begin[(self._get_pid(sm.key), elt)] = self.clock()
+
+    def _end_slice(self, sm, elt, cat, tid, args=None):
+        """Hook called when a State is exited."""
+        pid = self._get_pid(sm.key)
+        t0 = self._begin.pop((pid, elt), None)
+        if t0 is not None:
+            self._complete(elt, cat, pid, tid, t0, self.clock(), args)
+
+    def _begin_action(self, sm, t, _):
+        """Hook called before a Transition's action is performed."""
+        self._begin_slice(sm, t)
+
+    def _end_action(self, sm, t, evt, tid):
+        """Hook called after a Transition's action is performed."""
+        self._end_slice(sm, t, 'action', tid, {'evt': repr(evt)})
+
+    def _complete(self, elt, cat, pid, tid, t0, t1, args=None):
+        """Emits a 'complete' event for elt."""
+        ts = self._ts(t0)
+        evt = {'name': str(elt), 'cat': cat, 'ph': 'X', 'pid': pid,
+               'tid': tid, 'ts': ts, 'dur': self._ts(t1) - ts}
+        if args:
+            evt['args'] = args
+        self._emit(evt)
+
+    def _emit(self, evt):
+        """Buffers a trace event, the buffer is written out when full."""
+        with self._lock:
+            buf = self._buffer
+            buf.append(self._sep)
+            buf.append(json.dumps(evt))
+            self._sep = ',\n'
+            if len(buf) >= 2 * self.buffer_size:
+                self._flush()
+
+    def _flush(self):
+        """Writes out the buffered events (called with _lock held)."""
+        self._stream.write(''.join(self._buffer))
+        self._buffer = []
+
+    def flush(self):
+        """Writes out all buffered trace events."""
+        with self._lock:
+            self._flush()
+            self._stream.flush()
+
+    def close(self):
+        """Ends slices of the States that are still active and terminates
+           the trace."""
+        t1 = self.clock()
+        begin, self._begin = self._begin, {}
+        for ((pid, elt), t0) in begin.items():
+            self._complete(elt, 'state', pid, self._tids.get(elt, 0), t0, t1)
+        with self._lock:
+            self._buffer.append('\n]\n')
+            self._flush()
+            if self._own_stream:
+                self._stream.close()
+            else:
+                self._stream.flush()
+
+# vim:expandtab:sw=4:sts=4
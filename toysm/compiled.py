@@ -0,0 +1,139 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# pylint: disable=protected-access
+
+"""
+Compiled form of the State graph of a StateMachine.
+
+A CompiledGraph numbers the States of the graph (in a deterministic
+order, see State._order) and holds tables derived from the graph
+structure, e.g. the depth and parent of each State and the exit/entry
+paths of each Transition, that the StateMachine would otherwise compute
+while processing events. A graph is compiled once (see CompiledGraph.of),
+the StateMachines using it share the tables.
+"""
+
+from toysm.core import IllFormedException, _ordered
+from toysm.public import public
+
+
+def _preorder(root):
+    """Returns the States under root (included) in depth first order,
+       children being visited in creation order."""
+    states = []
+    stack = [root]
+    while stack:
+        state = stack.pop()
+        states.append(state)
+        stack.extend(reversed(_ordered(state.children)))
+    return states
+
+
+@public
+class CompiledGraph(object):
+    """Tables derived from the structure of the State graph under root.
+
+       Attributes:
+           states:    the States of the graph in depth first order, a
+                      State's id is its position in the list.
+           ids:       State -> id.
+           depth:     id -> depth of the State (0 for the root).
+           parents:   id -> id of the State's parent (-1 for the root).
+           paths:     (source, target) -> (exit path, entry path) as
+                      returned by lca, for each Transition.
+           sm_tables: tables computed by StateMachines using the graph,
+                      see StateMachine.freeze.
+    """
+
+    @classmethod
+    def of(cls, root):
+        """Returns the CompiledGraph of the graph under root.
+
+           The graph is compiled and frozen (see State.freeze) the
+           first time, later calls for the same root return the same
+           CompiledGraph.
+        """
+        compiled = root.__dict__.get('_compiled_graph')
+        if compiled is None:
+            compiled = cls(root)
+            for state in compiled.states:
+                state.freeze()
+                for t in state.transitions:
+                    t.freeze()
+            root._compiled_graph = compiled
+        return compiled
+
+    def __init__(self, root):
+        self.states = states = _preorder(root)
+        self.ids = ids = {s: i for (i, s) in enumerate(states)}
+        # parents come before their children in states
+        self.depth = depth = [0] * len(states)
+        self.parents = parents = [-1] * len(states)
+        for i in range(1, len(states)):
+            parents[i] = p = ids[states[i].parent]
+            depth[i] = depth[p] + 1
+        self.sm_tables = None
+        self.paths = {}
+        for state in states:
+            for t in state.transitions:
+                tgt = t.target or t.source
+                if tgt not in ids:
+                    raise IllFormedException(
+                        '%s targets %s, which is not part of the State '
+                        'graph of %s' % (t, tgt, root))
+                if (state, tgt) not in self.paths:
+                    self.paths[(state, tgt)] = self._lca(state, tgt)
+
+    def _lca(self, a, b):
+        """Computes the paths to the least common ancestor of States a
+           and b, see lca."""
+        states, ids, depth, parents = \
+            self.states, self.ids, self.depth, self.parents
+        i, j = ids[a], ids[b]
+        a_path, b_path = [], []
+        while depth[i] > depth[j]:
+            a_path.append(states[i])
+            i = parents[i]
+        while depth[j] > depth[i]:
+            b_path.append(states[j])
+            j = parents[j]
+        while i != j:
+            a_path.append(states[i])
+            b_path.append(states[j])
+            i, j = parents[i], parents[j]
+        a_path.append(states[i])  # LCA found
+        b_path.append(states[j])
+        b_path.reverse()
+        return a_path, b_path
+
+    def lca(self, a, b):
+        """Returns paths to the least common ancestor of States a and b:
+           [a, ..., lca], [lca, ..., b]. The paths must not be modified."""
+        paths = self.paths.get((a, b))
+        if paths is None:
+            # e.g. entry into a State's initial substate
+            paths = self.paths[(a, b)] = self._lca(a, b)
+        return paths
+
+# vim:expandtab:sw=4:sts=4
@@ -24,9 +24,9 @@
 # pylint: disable=unexpected-keyword-arg, no-value-for-parameter
 # pylint: disable=invalid-name
 
+from itertools import count
 from threading import Thread, Event, Lock
-from inspect import isclass
-from six import with_metaclass
+from inspect import isclass, isgeneratorfunction
 from toysm.public import public
 import logging
 
@@ -43,10 +43,89 @@ class IllFormedException(Exception):
     pass
 
 
+def with_metaclass(meta, *bases):
+    """Returns a base class, to be used in a class definition, that
+       gives the defined class the meta metaclass in both Python 2
+       and 3 (as six.with_metaclass)."""
+    class metaclass(type):
+        """Temporary metaclass replaced by meta when the class using
+           the returned base class is defined."""
+        def __new__(mcs, name, this_bases, d):
+            return meta(name, bases, d)
+
+        @classmethod
+        def __prepare__(mcs, name, this_bases):
+            return meta.__prepare__(name, bases)
+    return type.__new__(metaclass, 'temporary_class', (), {})
+
+
+# Creation order of States
+_state_order = count()
+
+# Aliases of State hook kinds (see State.add_hook)
+_HOOK_ALIASES = {'entry': 'pre_entry', 'enter': 'pre_entry',
+                 'exit': 'post_exit'}
+
+
+def _ordered(states):
+    """Returns states sorted in creation order."""
+    return sorted(states, key=lambda s: s._order)  # pylint: disable=W0212
+
+
+# (class, function) used by event_keys for events of class
+_event_key_funcs = []
+
+
+@public
+def add_event_keys(cls, func):
+    """Registers func(evt) as returning additional keys (see event_keys)
+       for events that are instances of cls.
+
+       Allows events that aren't hashable to be reduced to keys, e.g.
+       the classes of the layers of a scapy Packet.
+    """
+    _event_key_funcs.append((cls, func))
+
+
+@public
+def remove_event_keys(cls, func):
+    """Unregisters a function registered with add_event_keys."""
+    _event_key_funcs.remove((cls, func))
+
+
+@public
+def event_keys(evt):
+    """Returns the set of keys of evt: evt itself, the classes it is an
+       instance of and the keys returned by functions registered with
+       add_event_keys. A transition can only be triggered by evt if its
+       interest contains one of these keys.
+
+       Returns None if evt can't be reduced to keys (i.e. it isn't
+       hashable and no function was registered for it).
+    """
+    keys = set(type(evt).__mro__)
+    registered = False
+    for cls, func in _event_key_funcs:
+        if isinstance(evt, cls):
+            keys.update(func(evt))
+            registered = True
+    try:
+        keys.add(evt)
+    except TypeError:
+        if not registered:
+            return None
+    return keys
+
+
 class _StateDescriptor(object):
     """Holder for the dynamic components of a State."""
 
     def __init__(self, copy=None):
+        self.reset(copy)
+
+    def reset(self, copy=None):
+        """(Re-)initializes the descriptor, allows descriptors of a
+           terminated StateMachine instance to be reused."""
         if copy:
             self.active_substate = copy.active_substate
         else:
@@ -56,6 +135,11 @@ class _StateDescriptor(object):
         self.do_thread = None
         self.exit_required = None
         self.activity_complete = True
+        # Generator do-activities: the generator, the sched event or the
+        # condition it is waiting on.
+        self.do_gen = None
+        self.do_sched_id = None
+        self.do_cond = None
 
         # The following are used when a State both has children and a
         # do-activity
@@ -63,6 +147,21 @@ class _StateDescriptor(object):
         self.complete = False
         self.lock = None
 
+    def clone(self):
+        """Returns an independent copy of the descriptor."""
+        cpy = object.__new__(type(self))
+        cpy.copy_from(self)
+        return cpy
+
+    def copy_from(self, other):
+        """Makes the descriptor an independent copy of other."""
+        self.__dict__.update(other.__dict__)
+
+
+def _func(method):
+    """Returns the function implementing method (Python 2 and 3)."""
+    return getattr(method, '__func__', method)
+
 
 @public
 class State(object):
@@ -78,8 +177,11 @@ class State(object):
     # Factory method that yields a holder for the dynamic part of the State.
     _descriptor_type = _StateDescriptor
 
+    # True once the State is frozen (see freeze)
+    _frozen = False
+
     def __init__(self, name=None, sexp=None, parent=None, initial=False,
-                 on_enter=None, on_exit=None, do=None):
+                 on_enter=None, on_exit=None, do=None, defer=None):
         """
         Parameters:
         name      A name for the state
@@ -102,7 +204,8 @@ class State(object):
                   arguments are passed into the function as with on_enter.
 
         do        function representing the do-activity of this state,
-                  it will be run on dedicated thread. the function is called
+                  it will be run on a dedicated thread (or by the executor
+                  of the StateMachine if it has one). The function is called
                   with the following arguments (sm, state, event),
                   where sm and state are as in on_enter. The event argument
                   is an Event object that will be set if the StateMachine needs
@@ -111,8 +214,30 @@ class State(object):
                   The function should return a 'True' value if it needs
                   to be called repetitively (loop). As soon as any 'False'
                   value is returned, the do-activity is considered complete.
+                  Alternatively, do can be a generator function, called
+                  with the arguments (sm, state). The generator is then
+                  advanced by the StateMachine's own thread, it yields to
+                  wait for:
+                  - a number: delay (in seconds) before it is resumed,
+                  - a callable: condition (called without arguments)
+                    that is checked after each event processed by the
+                    StateMachine instance, the generator is resumed once
+                    it returns a 'True' value,
+                  - None: the generator is resumed as soon as possible.
+                  The do-activity is complete when the generator returns,
+                  if the State is exited before then, the generator is
+                  closed.
+
+        defer     events deferred while the State is active: either a list
+                  of events or a function called with the arguments
+                  (sm, evt) that returns True for the events to defer.
+                  An event that doesn't trigger any transition is kept
+                  by the StateMachine instance if an active State defers
+                  it, deferred events are processed again once the States
+                  deferring them are exited.
         """
         super(State, self).__init__()
+        self._order = next(_state_order)
         self.transitions = []
         self.rev_transitions = []
         self.name = name
@@ -131,6 +256,8 @@ class State(object):
         self._on_enter = on_enter
         self._on_exit = on_exit
         self.do_activity = do
+        self.defer = defer if defer is None or callable(defer) \
+            else tuple(defer)
 
     def get_enabled_transitions(self, sm, evt):
         """Return transitions from the state for the given event, or None
@@ -140,7 +267,7 @@ class State(object):
         # children transitions have a higher priority
         if evt:
             active_substate = sm.retrieve_state(self).active_substate
-            if active_substate:
+            if active_substate and sm._may_react(active_substate, evt):
                 substate_transitions = \
                     active_substate.get_enabled_transitions(sm, evt)
                 if substate_transitions:
@@ -191,14 +318,42 @@ class State(object):
         sm.retrieve_state(self).final_reached = True
         self._check_completion(sm)
 
+    def _has_pure_entry(self, callbacks=False):
+        """Returns True if entering the State has no effect beyond the
+           data the StateMachine instance keeps for it (descriptors and
+           completion events), i.e. the entry can be replicated by copying
+           that data. If callbacks is True, entry callbacks and hooks are
+           assumed to be free of side effects."""
+        if self.do_activity is not None or \
+                any(isinstance(t, Timeout) for t in self.transitions):
+            return False
+        return callbacks or (
+            self._on_enter is None and
+            not self.hooks['pre_entry'] and not self.hooks['post_entry'] and
+            _func(type(self).on_entry) is _func(State.on_entry))
+
+    def defers(self, sm, evt):
+        """Returns True if evt is deferred while this State is active."""
+        defer = self.defer
+        if defer is None:
+            return False
+        elif callable(defer):
+            return defer(sm, evt)
+        else:
+            return evt in defer
+
     def _call_hooks(self, sm, kind):
-        """Calls the hooks registered for 'kind'."""
+        """Calls the hooks registered for 'kind', then those registered
+           with the StateMachine (see StateMachine.add_state_hook)."""
         if LOG.isEnabledFor(logging.DEBUG) and self.hooks[kind]:
             LOG.debug("%s - calling %s hooks", self, kind)
         for hook in self.hooks[kind]:
             LOG.debug(hook)
             h, args, kargs = hook
             h(sm, self, *args, **kargs)
+        if sm._elt_hooks:  # pylint: disable=protected-access
+            for h, args, kargs in sm._elt_hooks.get((self, kind), ()):
+                h(sm, self, *args, **kargs)
 
     def on_entry(self, sm):
         """Called when the state is entered.
@@ -213,6 +368,8 @@ class State(object):
            should be implemented in _enter_actions.
         """
         LOG.debug("%s - Entering state", self)
+        if sm._index is not None and not isinstance(self, PseudoState):
+            sm._index[self].add(sm.key)  # pylint: disable=protected-access
         self._call_hooks(sm, 'pre_entry')
         if self._on_enter is not None:
             self._on_enter(sm, self)
@@ -243,15 +400,24 @@ class State(object):
            FinalState."""
         if self.do_activity and self.children:
             desc = sm.retrieve_state(self)
-            with desc.lock:
-                if (not desc.complete and
-                        desc.activity_complete and
-                        desc.final_reached):
-                    desc.complete = True
-                    sm.post_completion(self)
+            if desc.lock is None:
+                # Generator do-activity, only the SM thread is involved
+                self._post_completion_if_done(sm, desc)
+            else:
+                with desc.lock:
+                    self._post_completion_if_done(sm, desc)
         else:
             sm.post_completion(self)
 
+    def _post_completion_if_done(self, sm, desc):
+        """Posts a completion event if both the do-activity and the
+           children of the State have completed."""
+        if (not desc.complete and
+                desc.activity_complete and
+                desc.final_reached):
+            desc.complete = True
+            sm.post_completion(self)
+
     def on_exit(self, sm):
         """Called when the state is exited.
            This method is designed to be overridden to provide exit
@@ -275,7 +441,12 @@ class State(object):
             self.on_exit(sm)
             if self._on_exit is not None:
                 self._on_exit(sm, self)
+            if self.defer is not None and sm._deferred:
+                sm._release_deferred(self)  # pylint: disable=W0212
             self._call_hooks(sm, 'post_exit')
+            if sm._index is not None and not isinstance(self, PseudoState):
+                # pylint: disable=protected-access
+                sm._index[self].discard(sm.key)
             LOG.debug("%s - Exiting state", self)
 
     def _exit_actions(self, sm, only_children=False):
@@ -292,35 +463,157 @@ class State(object):
         do_activity = self.do_activity
         desc = sm.retrieve_state(self)
         desc.activity_complete = False
+        if isgeneratorfunction(do_activity):
+            LOG.debug("%s - Starting generator do-activity", self)
+            desc.do_gen = do_activity(sm, self)
+            self._advance_do_activity(sm)
+            return
         if desc.lock is None and self.children:
             desc.lock = Lock()
         exit_required = desc.exit_required = Event()
 
         def do():
             """target for the do-activity Thread."""
-            while not exit_required.is_set():
-                if not do_activity(sm, self, exit_required):
-                    desc.activity_complete = True
-                    self._check_completion(sm)
-                    break
+            try:
+                while not exit_required.is_set():
+                    if not do_activity(sm, self, exit_required):
+                        desc.activity_complete = True
+                        self._check_completion(sm)
+                        break
+            finally:
+                sm._do_activity_stopped(exit_required)
             desc.do_thread = None
+            if sm.async_do_exit and exit_required.is_set():
+                # The StateMachine may be waiting for the activity to stop
+                sm.resume()
 
-        desc.do_thread = Thread(target=do)
         LOG.debug("%s - Starting do-activity", self)
-        desc.do_thread.start()
+        sm._do_activity_started(exit_required)
+        if sm.executor is None:
+            desc.do_thread = Thread(target=do)
+            desc.do_thread.start()
+        else:
+            # pylint: disable=protected-access
+            desc.do_thread = sm._submit_do_activity(do)
 
     def stop_do_activity(self, sm, _):
         """Stop the State's do-activity thread."""
         desc = sm.retrieve_state(self)
+        if isgeneratorfunction(self.do_activity):
+            if desc.do_gen is not None:
+                self._close_do_activity(sm, desc)
+            return
         desc.exit_required.set()
         do_thread = desc.do_thread
         if do_thread:
             LOG.debug("%s - Waiting for do-activity to exit", self)
-            do_thread.join()
+            if isinstance(do_thread, Thread):
+                do_thread.join()
+            elif do_thread.cancel():
+                sm._do_activity_stopped(desc.exit_required)
+            else:
+                # Future already running, wait for it to finish (its
+                # exception if any is logged by the StateMachine)
+                do_thread.exception()
             LOG.debug("%s - Do-activity tread stopped", self)
 
+    def _stop_do_activity_async(self, sm):
+        """Requires the State's do-activity thread to exit without waiting
+           for it. Returns True if it is still running."""
+        desc = sm.retrieve_state(self)
+        if desc.exit_required is None or isgeneratorfunction(self.do_activity):
+            return False
+        desc.exit_required.set()
+        do_thread = desc.do_thread
+        if do_thread is None:
+            return False
+        if isinstance(do_thread, Thread):
+            # The thread resets do_thread before checking exit_required
+            # and calling sm.resume()
+            return True
+        if do_thread.cancel():
+            sm._do_activity_stopped(desc.exit_required)
+            return False
+        if do_thread.done():
+            return False
+        do_thread.add_done_callback(lambda _: sm.resume())
+        return True
+
+    def _advance_do_activity(self, sm):
+        """Resumes the State's generator do-activity until it waits for
+           a delay or an unfulfilled condition, or returns."""
+        desc = sm.retrieve_state(self)
+        desc.do_sched_id = desc.do_cond = None
+        try:
+            wait = next(desc.do_gen)
+            while callable(wait) and wait():
+                wait = next(desc.do_gen)
+        except StopIteration:
+            LOG.debug("%s - Generator do-activity complete", self)
+            desc.do_gen = None
+            desc.activity_complete = True
+            self._check_completion(sm)
+            return
+        except Exception as exc:  # pylint: disable=broad-except
+            # As for do-activities run in threads, the failure doesn't
+            # stop the StateMachine (and its other instances).
+            desc.do_gen = None
+            desc.activity_complete = True
+            sm._do_activity_failed(self, exc)  # pylint: disable=W0212
+            self._check_completion(sm)
+            return
+        if callable(wait):
+            desc.do_cond = wait
+            sm._do_polls.append(self)  # pylint: disable=protected-access
+        else:
+            # pylint: disable=protected-access
+            desc.do_sched_id = sm._sched.enter(
+                wait or 0, 10, self._advance_do_activity, [sm])
+
+    def _poll_do_activity(self, sm):
+        """Resumes the State's generator do-activity if the condition
+           it is waiting on is fulfilled."""
+        desc = sm.retrieve_state(self)
+        if desc.do_cond is not None and desc.do_cond():
+            sm._do_polls.remove(self)  # pylint: disable=protected-access
+            self._advance_do_activity(sm)
+
+    def _close_do_activity(self, sm, desc):
+        """Stops the State's generator do-activity."""
+        if desc.do_sched_id is not None:
+            sm._sched.cancel(desc.do_sched_id)  # pylint: disable=W0212
+        elif desc.do_cond is not None:
+            sm._do_polls.remove(self)  # pylint: disable=protected-access
+        gen = desc.do_gen
+        desc.do_gen = desc.do_sched_id = desc.do_cond = None
+        gen.close()
+
+    def freeze(self):
+        """Makes the State's relations immutable, called when the
+           StateMachine using the State is started (see
+           StateMachine.freeze).
+
+           children, transitions, rev_transitions and hooks are turned
+           into tuples (children in creation order), any later attempt
+           at modifying them raises an IllFormedException.
+        """
+        if self._frozen:
+            return
+        self.children = tuple(_ordered(self.children))
+        self.transitions = tuple(self.transitions)
+        self.rev_transitions = tuple(self.rev_transitions)
+        self.hooks = {k: tuple(v) for (k, v) in self.hooks.items()}
+        self._frozen = True
+
+    def _check_not_frozen(self):
+        """Raises an IllFormedException if the State is frozen."""
+        if self._frozen:
+            raise IllFormedException('%s cannot be modified once its '
+                                     'StateMachine is started' % self)
+
     def add_transition(self, t):
         """Sets this state as the source of Transition t."""
+        self._check_not_frozen()
         if t.source is not None:
             raise IllFormedException('Transition %s cannot be added to %s '
                                      'because it already has a source'
@@ -330,6 +623,7 @@ class State(object):
 
     def accept_transition(self, t):
         """Called when a transition designates the state as its target."""
+        self._check_not_frozen()
         t.target = self
         self.rev_transitions.append(t)
 
@@ -359,6 +653,9 @@ class State(object):
         """Connects a parent state to a substate."""
         if not (substate.parent is None or substate.parent is parent):
             raise IllFormedException('State %s already has a parent' % substate)
+        # pylint: disable=protected-access
+        parent._check_not_frozen()
+        substate._check_not_frozen()
 
         parent.accept_substate(substate, initial=initial)
         substate.accept_parent(parent, initial=initial)
@@ -377,9 +674,8 @@ class State(object):
            one of 'pre_entry, post_entry, pre_exit, post_exit' for more
            specific requirements.
         """
-        kind = {'entry': 'pre_entry',
-                'enter': 'pre_entry',
-                'exit': 'post_exit'}.get(kind, kind)
+        kind = _HOOK_ALIASES.get(kind, kind)
+        self._check_not_frozen()
         self.hooks[kind].append((hook, args, kargs))
 
     def set_active_substate(self, sm, state, transition_followed):
@@ -393,11 +689,19 @@ class State(object):
            the method is called on. The result will include the State
            itself.
         """
-        desc = sm.retrieve_state(self)
-        yield (self, self._descriptor_type(desc))
-        if desc.active_substate:
-            for i in desc.active_substate.get_active_states(sm):
-                yield i
+        # pylint: disable=protected-access
+        stack = [self]
+        while stack:
+            state = stack.pop()
+            desc = sm.retrieve_state(state)
+            yield (state, state._descriptor_type(desc))
+            stack.extend(reversed(state._active_children(desc)))
+
+    @staticmethod
+    def _active_children(desc):
+        """Returns the list of active substates given the State's
+           descriptor."""
+        return [desc.active_substate] if desc.active_substate else []
 
     def restore_state(self, sm, saved):
         """Restore the State to a previously saved condition.
@@ -427,6 +731,7 @@ class State(object):
                             on_enter=self._on_enter,
                             on_exit=self._on_exit)
         s_copy.do_activity = self.do_activity
+        s_copy.defer = self.defer
         return s_copy
 
 
@@ -473,11 +778,18 @@ class ParallelRegion(State):
 class _ParallelStateDescriptor(_StateDescriptor):
     """Holder for the dynamic components of a State."""
 
-    def __init__(self, copy=None):
-        super(_ParallelStateDescriptor, self).__init__()
+    def reset(self, copy=None):
+        super(_ParallelStateDescriptor, self).reset()
         del self.active_substate
+        self.__dict__.pop('still_running_children', None)
         if copy:
-            self.still_running_children = copy.still_running_children.copy()
+            self.still_running_children = list(copy.still_running_children)
+
+    def copy_from(self, other):
+        self.__dict__.clear()
+        super(_ParallelStateDescriptor, self).copy_from(other)
+        if hasattr(other, 'still_running_children'):
+            self.still_running_children = list(other.still_running_children)
 
 
 @public
@@ -492,6 +804,21 @@ class ParallelState(State):
         super(ParallelState, self).__init__(*args, **kargs)
         self._history = set()
 
+    def freeze(self):
+        if self._frozen:
+            return
+        self._history = frozenset(self._history)
+        self._regions = self._get_regions()
+        super(ParallelState, self).freeze()
+
+    def _get_regions(self):
+        """Returns the regions of the ParallelState (i.e. its children
+           except DeepHistoryStates) in creation order."""
+        if self._frozen:
+            return self._regions
+        return tuple(c for c in _ordered(self.children)
+                     if c not in self._history)
+
     def accept_substate(self, state, initial):
         if initial:
             raise IllFormedException("When adding to a ParallelState, no "
@@ -509,7 +836,8 @@ class ParallelState(State):
         substate_transitions = []
         still_running_children = sm.retrieve_state(self).still_running_children
         for c in still_running_children:
-            substate_transitions += c.get_enabled_transitions(sm, evt)
+            if sm._may_react(c, evt):  # pylint: disable=protected-access
+                substate_transitions += c.get_enabled_transitions(sm, evt)
         if substate_transitions:
             return substate_transitions
         else:
@@ -519,7 +847,7 @@ class ParallelState(State):
         """Returns the list of transitions triggered by entering this state."""
         # pylint: disable=protected-access
         transitions = []
-        for c in self.children - self._history:
+        for c in self._get_regions():
             transitions.append(Transition(source=self, target=c,
                                           kind=Transition._ENTRY))
             _, entry_transitions = c.get_entry_transitions(sm)
@@ -539,19 +867,15 @@ class ParallelState(State):
 
     def _enter_actions(self, sm):
         sm.retrieve_state(self).still_running_children = \
-            self.children - self._history
+            list(self._get_regions())
 
     def _exit_actions(self, sm, only_children=False):
-        for c in self.children - self._history:
+        for c in self._get_regions():
             c._exit(sm)  # pylint: disable=protected-access
 
-    def get_active_states(self, sm):
-        desc = sm.retrieve_state(self)
-        still_running_children = desc.still_running_children
-        yield (self, self._descriptor_type(desc))
-        for i in still_running_children:
-            for j in i.get_active_states(sm):
-                yield j
+    @staticmethod
+    def _active_children(desc):
+        return list(desc.still_running_children)
 
     def set_active_substate(self, sm, state, transition_followed):
         # pylint: disable = protected-access
@@ -790,6 +1114,9 @@ class TerminateState(_SinkState):
     def _enter_actions(self, sm):
         sm.stop()
 
+    def _has_pure_entry(self, callbacks=False):
+        return False
+
 
 @public
 class EntryState(Junction):
@@ -928,6 +1255,9 @@ class Transition(with_metaclass(TransitionMeta)):
                 LOCAL    default type of transition, on_enter/on_exit are only
                          called when the target/source node isn't a substate/
                          superstate.
+       - event_types [optional] classes of the events that can trigger the
+                     transition, allows the StateMachine to avoid evaluating
+                     the transition for other events (see interest).
     """
     INTERNAL = 'internal'
     EXTERNAL = 'external'
@@ -936,17 +1266,25 @@ class Transition(with_metaclass(TransitionMeta)):
 
     _transition_cls = []  # list of known subclasses
 
+    event_types = None
+
+    # True once the Transition is frozen (see freeze)
+    _frozen = False
+
     dot = {
         'label': lambda t: t.desc
     }
 
     def __init__(self, trigger=None, action=None, source=None, target=None,
-                 kind=LOCAL, desc=''):
+                 kind=LOCAL, desc='', event_types=None):
         self.trigger = trigger
+        if event_types is not None:
+            self.event_types = tuple(event_types)
         self.action = action
         self.kind = kind
         self.desc = desc
         self.hooks = []
+        self.post_hooks = []
         if kind is self._ENTRY:
             self.source = source
             self.target = target
@@ -982,22 +1320,75 @@ class Transition(with_metaclass(TransitionMeta)):
                   self, evt, triggered)
         return triggered
 
+    def interest(self):
+        """Returns the event keys (see event_keys) of the events that may
+           trigger the transition, or None if any event may trigger it.
+           Used to skip the States, regions and StateMachine instances
+           that can't react to an event.
+
+           This method can be overridden by subclasses, by default the
+           transition is interested in the event_types it was created with.
+        """
+        if self.event_types is None:
+            return None
+        return frozenset(self.event_types)
+
     def _action(self, sm, evt):
         """Called when the StateMachine follows this transition."""
+        # pylint: disable=protected-access
+        elt_hooks = sm._elt_hooks
         for hook in self.hooks:
             h, args, kargs = hook
             h(sm, self, evt, *args, **kargs)
+        if elt_hooks:
+            for h, args, kargs in elt_hooks.get((self, 'action'), ()):
+                h(sm, self, evt, *args, **kargs)
         self.do_action(sm, evt)
+        for hook in self.post_hooks:
+            h, args, kargs = hook
+            h(sm, self, evt, *args, **kargs)
+        if elt_hooks:
+            for h, args, kargs in elt_hooks.get((self, 'post_action'), ()):
+                h(sm, self, evt, *args, **kargs)
 
     def do_action(self, sm, evt):
         """Called when this transition is followed."""
         if self.action:
             self.action(sm, evt)
 
+    def _is_pure(self, callbacks=False):
+        """Returns True if following the Transition has no side effects
+           and doesn't depend on anything but the StateMachine instance's
+           data. If callbacks is True, triggers, actions and hooks are
+           assumed to be free of side effects."""
+        return callbacks or (
+            self.trigger is None and self.action is None and
+            not self.hooks and not self.post_hooks and
+            _func(type(self).do_action) is _func(Transition.do_action))
+
+    def freeze(self):
+        """Makes the Transition's hooks immutable (see State.freeze)."""
+        self.hooks = tuple(self.hooks)
+        self.post_hooks = tuple(self.post_hooks)
+        self._frozen = True
+
+    def _check_not_frozen(self):
+        """Raises an IllFormedException if the Transition is frozen."""
+        if self._frozen:
+            raise IllFormedException('%s cannot be modified once its '
+                                     'StateMachine is started' % self)
+
     def add_hook(self, hook, *args, **kargs):
         """Add a hook that will be called when this transition is followed."""
+        self._check_not_frozen()
         self.hooks.append((hook, args, kargs))
 
+    def add_post_hook(self, hook, *args, **kargs):
+        """Add a hook that will be called once the action of this transition
+           has been performed."""
+        self._check_not_frozen()
+        self.post_hooks.append((hook, args, kargs))
+
     def __str__(self):
         return '%s-%s>%s' % (self.source,
                              "[%s]-" % self.desc if self.desc else '',
@@ -1029,7 +1420,7 @@ class Transition(with_metaclass(TransitionMeta)):
         cpy = cpy or type(self)()
         if skip_fields is None:
             skip_fields = set()
-        skip_fields |= {'source', 'target', 'hooks'}
+        skip_fields |= {'source', 'target', 'hooks', 'post_hooks', '_frozen'}
         cpy.__dict__.update({k: v for (k, v) in self.__dict__.items()
                              if k not in skip_fields})
         return cpy
@@ -1047,6 +1438,9 @@ class CompletionTransition(Transition):
     def is_triggered(self, sm, evt):
         return evt is None
 
+    def interest(self):
+        return frozenset()
+
 
 @public
 class EqualsTransition(Transition):
@@ -1068,6 +1462,15 @@ class EqualsTransition(Transition):
     def is_triggered(self, sm, evt):
         return evt is not None and self.value == evt
 
+    def interest(self):
+        if _func(type(self).is_triggered) is not \
+                _func(EqualsTransition.is_triggered):
+            return None  # matching redefined by a subclass
+        try:
+            return frozenset((self.value,))
+        except TypeError:  # value isn't hashable
+            return None
+
     def __copy__(self):
         cpy = type(self)(evt_value=self.value)
         return super(EqualsTransition, self).__copy__(cpy)
@@ -1136,6 +1539,11 @@ class Timeout(Transition):
         LOG.debug('timeout triggered: %s, %r %r', self, evt, self._sched_id)
         return self is evt
 
+    def interest(self):
+        if _func(type(self).is_triggered) is not _func(Timeout.is_triggered):
+            return None  # matching redefined by a subclass
+        return frozenset((self,))
+
     def __copy__(self):
         cpy = type(self)(delay=self.delay)
         return super(Timeout, self).__copy__(cpy)
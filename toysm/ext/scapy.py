@@ -47,7 +47,8 @@ except ImportError:
          ImportWarning)
     HAVE_PIPETOOL = False
 
-from toysm import StateMachine, Transition, public
+from toysm import StateMachine, Transition, add_event_keys, public
+from toysm.core import _func
 from toysm.base_sm import SMMeta
 from toysm.public import public
 
@@ -147,6 +148,26 @@ class PacketTransition(Transition):
     def is_triggered(self, sm, evt):
         return evt is not None and match_packet(self.template, evt)
 
+    def interest(self):
+        if _func(type(self).is_triggered) is not \
+                _func(PacketTransition.is_triggered):
+            return None  # matching redefined by a subclass
+        # match_packet requires one of the packet's layers to be an
+        # instance of the template's class.
+        template = self.template
+        return frozenset((template if isclass(template) else type(template),))
+
+
+def _packet_keys(packet):
+    """Event keys of a Packet: the classes of its layers."""
+    while not isinstance(packet, NoPayload):
+        for cls in type(packet).__mro__:
+            yield cls
+        packet = packet.payload
+
+
+add_event_keys(Packet, _packet_keys)
+
 
 if HAVE_PIPETOOL:
     class SMBoxMeta(SMMeta, Pipe.__metaclass__):
@@ -36,13 +36,12 @@ except ImportError:
     # python2
     # pylint: disable=import-error
     import Queue as queue
-import sched
+from collections import deque, defaultdict
 import time
-import subprocess
-from threading import Thread
+from threading import Thread, Lock, current_thread
 import sys
-from toysm.core import State, PseudoState, ParallelState, InitialState, \
-    Transition
+from toysm.core import State, PseudoState, ParallelState, \
+    Transition, _StateDescriptor, _HOOK_ALIASES, event_keys
 from toysm.public import public
 from toysm.event_queue import EventQueue
 from toysm.base_sm import BaseStateMachine, BadSMDefinition
@@ -50,52 +49,35 @@ import logging
 
 LOG = logging.getLogger(__name__)
 
-# Dot binaries / command lines
-DOT = 'dot'
-XDOT = 'xdot -'
-
 # Event types/priorities
+RESUME_EVENT = -1
 COMPLETION_EVENT = 0
 INIT_EVENT = 1
-STD_EVENT = 2
+DEFERRED_EVENT = 2
+STD_EVENT = 3
 
+# Event marking the point where a stopped SMState can be reused
+_RELEASE = object()
 
-def _bytes(string, enc='utf-8'):
-    """Returns bytes of the string argument. Compatible w/ Python 2
-       and 3."""
-    if sys.version_info.major < 3:
-        return string
-    else:
-        return bytes(string, enc)
 
+def _union(interests):
+    """Returns the union of event keys sets, None (any event) if one
+       of them is None."""
+    keys = set()
+    for interest in interests:
+        if interest is None:
+            return None
+        keys.update(interest)
+    return frozenset(keys)
 
-def dot_attrs(obj, **overrides):
-    """Convert 'dot' attributes in a State or Transition for parsing by
-       the dot interpreter.
-    """
-    if overrides:
-        d = obj.dot.copy()
-        d.update(overrides)
-    else:
-        d = obj.dot
-
-    def resolve(item):
-        """Resolves the value for a dot attribute, i.e.
-           if the item is a callable use its return
-           value.
-           Return value will be quoted, unless it
-           is a HTML-like label.
-        """
-        k, v = item
-        if callable(v):
-            v = v(obj)
-        v = str(v)
-        if not (v.startswith('<') and v.endswith('>')):
-            v = '"%s"' % v.replace('"', r'\"')
-        return k, v
 
-    return ';'.join('%s=%s' % (k, v)
-                    for (k, v) in (resolve(i) for i in d.items()))
+class _Broadcast(object):
+    """Event posted to all/selected instances of a StateMachine."""
+    __slots__ = ('evt', 'where')
+
+    def __init__(self, evt, where):
+        self.evt = evt
+        self.where = where
 
 
 class SMState(object):
@@ -115,8 +97,36 @@ class SMState(object):
 
     def __init__(self, sm, key=None):
         self._sm = sm
+        # pylint: disable=protected-access
+        self._index = sm._index
+        self._elt_hooks = sm._elt_hooks
         self._state = {}
         self.key = key
+        # States whose generator do-activity waits on a condition
+        self._do_polls = []
+        # With async_do_exit, step waiting for do-activities to stop
+        # and events held until then.
+        self._parked = None
+        self._held = None
+        # Events deferred by active States (in order of arrival)
+        self._deferred = []
+        # _finished: all States have been exited
+        self._stopped = self._finished = False
+
+    def reset(self, key):
+        """Prepares a stopped SMState for reuse as the instance for key,
+           its descriptors are reset rather than re-allocated."""
+        state = self._state
+        for s, desc in list(state.items()):
+            if isinstance(desc, _StateDescriptor):
+                desc.reset()
+            else:
+                del state[s]
+        self.key = key
+        del self._do_polls[:]
+        del self._deferred[:]
+        self._parked = self._held = None
+        self._stopped = self._finished = False
 
     def __getattr__(self, name):
         return getattr(self._sm, name)
@@ -133,6 +143,20 @@ class SMState(object):
         """Saves the stored_state for the given state."""
         self._state[state] = stored_state
 
+    def _may_react(self, state, evt):
+        """Returns False if no transition of state and its substates can
+           be triggered by evt (see Transition.interest)."""
+        # pylint: disable=protected-access
+        if evt is None:
+            return True
+        sm = self._sm
+        interest = sm._interest.get(state)
+        if interest is None:
+            return True
+        if evt is not sm._keys_evt:
+            sm._keys_evt, sm._evt_keys = evt, event_keys(evt)
+        return sm._evt_keys is None or not interest.isdisjoint(sm._evt_keys)
+
     def post(self, *evts):
         """Adds an event to the State Machine instance's input processing
            queue."""
@@ -147,10 +171,39 @@ class SMState(object):
         """Stops this StateMachine instance."""
         self._sm.stop(sm_state=self)
 
+    def _release_deferred(self, state):
+        """Re-injects (in order of arrival) the deferred events that
+           <state>, being exited, defers and that no other active State
+           defers. The others stay deferred, in place."""
+        # pylint: disable=protected-access
+        sm = self._sm
+        deferred = []
+        for evt in self._deferred:
+            if state.defers(self, evt) \
+                    and not sm._is_deferred(self, evt, exclude=state):
+                sm._event_queue.put((self, evt), DEFERRED_EVENT)
+            else:
+                deferred.append(evt)
+        self._deferred = deferred
+
+    def _do_activity_failed(self, state, exc):
+        """Logs the failure of <state>'s generator do-activity and calls
+           the StateMachine's 'error' hooks (with evt None)."""
+        LOG.error('%s - do-activity of %s failed', self, state,
+                  exc_info=True)
+        for h, args, kargs in self._sm.hooks['error']:
+            h(self, None, exc, *args, **kargs)
+
+    def resume(self):
+        """Indicates that a do-activity of this State Machine instance
+           stopped after being required to exit."""
+        # pylint: disable=protected-access
+        self._sm._event_queue.put((self, None), RESUME_EVENT)
+
     def __str__(self):
         sm_str = str(self._sm)
         if self.key:
-            return '%s key=%i' % (sm_str, self.key)
+            return '%s key=%r' % (sm_str, self.key)
         else:
             return sm_str
 
@@ -174,8 +227,45 @@ class StateMachine(BaseStateMachine):
                 to determine which instance the evt will be routed to.
                 The demux function can modify evt and return the modifyed
                 version from the function.
+        executor: executor used to run the do-activities of States instead
+                of starting a Thread on each entry in such a State. Either
+                an object with a submit(fn) method returning a
+                concurrent.futures.Future (e.g. a ThreadPoolExecutor that can
+                be shared between StateMachines) or the maximum number of
+                threads of a ThreadPoolExecutor created for this
+                StateMachine (shut down when the StateMachine stops). Note
+                that a do-activity waiting on its exit_required Event
+                occupies a thread of the executor until its State is exited
+                or the StateMachine stops.
+        async_do_exit: if True, exiting States whose do-activity (run
+                by a Thread or an executor) is still running doesn't block
+                the StateMachine until the do-activity stops. Instead, the
+                do-activities are required to exit and the StateMachine
+                instance is suspended in the middle of its transition: it
+                processes other instances' events in the meantime, and
+                resumes the transition once all the do-activities have
+                stopped. Ordering is preserved for the suspended instance,
+                events posted to it (as well as completion events) are held
+                and processed in order after the transition is done. Note
+                that settle() doesn't wait for held events.
+        pure_init: with demux, the initial configuration is entered once
+                and new instances are created by copying the result if
+                entering it has no side effects: no do-activities,
+                Timeouts or TerminateStates and, unless pure_init is True
+                (i.e. they are declared free of side effects), no entry
+                callbacks/hooks and no transition triggers, actions or
+                hooks. False disables this optimization.
+        pool_size: with demux, maximum number of terminated instances
+                (SMStates and their State descriptors) kept for reuse by
+                new instances. Only instances that terminated by completing
+                (i.e. all their States were exited) are reused, once the
+                events queued for them have been discarded. Events must
+                not be posted to the SMState of a terminated instance.
+        index:  if True, the StateMachine maintains an index of the
+                instances in each State, see count_in() and instances_in().
         """
-        allowed_kargs = {'demux'}
+        allowed_kargs = {'demux', 'executor', 'async_do_exit', 'pure_init',
+                         'pool_size', 'index'}
         if not set(kargs.keys()) <= allowed_kargs:
             raise TypeError("Unexpected keyword argument(s) '%s'" %
                             (list(set(kargs.keys()) - allowed_kargs)))
@@ -202,17 +292,43 @@ class StateMachine(BaseStateMachine):
         # Event Queue shared by all instances of the State Machine
         # Queue elements are (SMState, evt) tuples
         self._event_queue = EventQueue(dflt_prio=STD_EVENT)
-
-        if sys.version_info.major > 3 \
-           or (sys.version_info.major == 3 and sys.version_info.minor >= 3):
-            self._sched = sched.scheduler()
-            self._v3sched = True
-        else:
-            self._sched = sched.scheduler(time.time, self._sched_wait)
-            self._v3sched = False
+        # Completion events raised by the SM thread, they are processed
+        # after the current event without going through the queue.
+        self._completions = deque()
+
+        # Scheduler for Timeouts and generator do-activities, created
+        # on first use (see _sched)
+        self._scheduler = None
+        self._v3sched = sys.version_info >= (3, 3)
         self._terminated = False
         self._thread = None
         self._demux = kargs.get('demux')
+        self.hooks = {'error': [], 'processed': []}
+        # (State/Transition, kind) -> hooks, see add_state_hook
+        self._elt_hooks = {}
+        executor = kargs.get('executor')
+        # Number of workers of an executor owned by the StateMachine
+        self._executor_workers = None
+        if isinstance(executor, int):
+            self._executor_workers = executor
+            executor = self._make_executor()
+        self.executor = executor
+        self.async_do_exit = kargs.get('async_do_exit', False)
+        self.pure_init = kargs.get('pure_init')
+        self.pool_size = kargs.get('pool_size', 0)
+        self._pool = []
+        # State -> set of keys of the instances in which it is active
+        self._index = defaultdict(set) if kargs.get('index') else None
+        # CompiledGraph of the frozen State graph (see freeze)
+        self._compiled = None
+        # (descriptors, completions) copied into new instances, False
+        # if the initial configuration can't be copied.
+        self._init_template = None
+        # do-activity Futures that haven't completed yet
+        self._do_futures = set()
+        # exit_required Events of the running do-activities
+        self._do_exits = set()
+        self._do_lock = Lock()
         # TODO: re-starting the StateMachine should clear these
         #       to allow a fresh run. However its also nice to be
         #       able to start posting to an SM even before
@@ -228,6 +344,7 @@ class StateMachine(BaseStateMachine):
         """Starts the StateMachine."""
         if self._thread:
             raise Exception('State Machine already started')
+        self.freeze()
         self._terminated = False
         self._thread = Thread(target=self._loop)
         self._thread.daemon = True
@@ -244,7 +361,7 @@ class StateMachine(BaseStateMachine):
             return True
         else:
             t.join(*args)
-            return not t.isAlive()
+            return not t.is_alive()
 
     def settle(self, timeout):
         """Returns once the SM has finished all available input events.
@@ -265,7 +382,15 @@ class StateMachine(BaseStateMachine):
         if sm_state is None or self._demux is None:
             self._terminated = True
         else:
-            del self._sm_instances[sm_state.key]
+            if self._index is not None and not sm_state._finished:
+                for state, _ in self._cstate.get_active_states(sm_state):
+                    self._index[state].discard(sm_state.key)
+            sm_state._stopped = True
+            if self._sm_instances.get(sm_state.key) is sm_state:
+                del self._sm_instances[sm_state.key]
+            if sm_state._finished and len(self._pool) < self.pool_size:
+                # Released once previously queued events are discarded
+                self._event_queue.put((sm_state, _RELEASE))
 
     def post(self, *evts, **kargs):
         """Adds event(s) to the State Machine's input processing queue.
@@ -288,36 +413,169 @@ class StateMachine(BaseStateMachine):
             self._event_queue.put(
                 self._get_sm_state(e, sm_state=kargs.get('sm_state')))
 
+    def broadcast(self, evt, where=None):
+        """Posts evt to all the instances of the StateMachine.
+
+        where:  optional selection of the instances the event is posted to,
+                either a State (instances in which it is active) or a
+                function called with each SMState that returns True for
+                the selected instances.
+
+        The event is queued once and dispatched to the instances when it
+        is processed. If the StateMachine maintains an index of its
+        instances (see index argument), instances where no active State
+        has a transition that evt may trigger (see Transition.interest)
+        or defers events are skipped without being visited.
+        """
+        if evt is None:
+            raise TypeError('Event posted to SM cannot be None.')
+        self._event_queue.put((None, _Broadcast(evt, where)))
+
     def post_completion(self, state, sm_state):
         """Indicates to the SM that the state has completed.
            Unlike StateMachine.post(), if demux is set then calls to
            post_completion need to position the sm_state argument."""
         LOG.debug('%s - %s - state completed', sm_state, state)
-        self._event_queue.put((sm_state, state), COMPLETION_EVENT)
-
-    def _assign_depth(self, state=None, depth=0):
-        """Assign _depth attribute to states used by the StateMachine.
-           Depth is 0 for the root of the graph and each level of
-           ancestor between a state and the root adds 1 to its depth.
+        if current_thread() is self._thread:
+            self._completions.append((sm_state, state))
+        else:
+            self._event_queue.put((sm_state, state), COMPLETION_EVENT)
+
+    def add_hook(self, kind, hook, *args, **kargs):
+        """Add a hook that will be called whenever <kind> occurs for this
+           StateMachine. Supported kinds:
+           - 'error': called as hook(sm_state, evt, exc, *args, **kargs)
+                      when processing evt raises exc. The exception is
+                      propagated once all 'error' hooks have been called.
+                      Also called (with evt None) when a generator
+                      do-activity raises exc, the activity is then
+                      considered complete and the exception isn't
+                      propagated.
+           - 'processed': called as hook(sm_state, evt, *args, **kargs)
+                          once an event posted to the StateMachine has been
+                          processed.
+        """
+        self.hooks[kind].append((hook, args, kargs))
+
+    def add_state_hook(self, state, kind, hook, *args, **kargs):
+        """Add a hook that will be called whenever <kind> occurs for
+           <state> in this StateMachine, see State.add_hook for the
+           supported kinds.
+
+           Unlike those added with State.add_hook, these hooks aren't
+           part of the State graph, which is shared by the StateMachines
+           using it (e.g. the instances of a StateMachine class) and
+           frozen once one of them is started. They can be added at any
+           time, e.g. to instrument a StateMachine (see
+           toysm.recorder).
         """
-        state = state or self._cstate
-        state._depth = depth  # pylint: disable = W0212
-        for c in state.children:
-            self._assign_depth(c, depth + 1)
-
-    def _lca(self, a, b):
-        """Returns paths to least common ancestor of states a and b."""
-        if a is b:
-            return [a], [b]  # LCA found
-        if a._depth < b._depth:  # pylint: disable = W0212
-            a_path, b_path = self._lca(a, b.parent)
-            return a_path, b_path + [b]
-        elif b._depth < a._depth:  # pylint: disable = W0212
-            a_path, b_path = self._lca(a.parent, b)
-            return [a] + a_path, b_path
+        kind = _HOOK_ALIASES.get(kind, kind)
+        if kind not in state.hooks:
+            raise ValueError('Unknown State hook kind %r' % kind)
+        self._elt_hooks.setdefault((state, kind), []).append(
+            (hook, args, kargs))
+
+    def add_transition_hook(self, t, hook, *args, **kargs):
+        """Add a hook that will be called when Transition t is followed
+           in this StateMachine (see Transition.add_hook and
+           add_state_hook)."""
+        self._elt_hooks.setdefault((t, 'action'), []).append(
+            (hook, args, kargs))
+
+    def add_transition_post_hook(self, t, hook, *args, **kargs):
+        """Add a hook that will be called once the action of Transition t
+           has been performed in this StateMachine (see
+           Transition.add_post_hook and add_state_hook)."""
+        self._elt_hooks.setdefault((t, 'post_action'), []).append(
+            (hook, args, kargs))
+
+    def _make_executor(self):
+        """Returns a new executor owned by the StateMachine."""
+        # pylint: disable=import-error
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=self._executor_workers)
+
+    def _do_activity_started(self, exit_required):
+        """Records the exit_required Event of a do-activity Thread/Future
+           so that it can be set when the StateMachine stops."""
+        with self._do_lock:
+            self._do_exits.add(exit_required)
+
+    def _do_activity_stopped(self, exit_required):
+        """Called when a do-activity Thread/Future is done."""
+        with self._do_lock:
+            self._do_exits.discard(exit_required)
+
+    def _submit_do_activity(self, do):
+        """Submits the do function of a do-activity to the executor,
+           returns the resulting Future."""
+        future = self.executor.submit(do)
+        self._do_futures.add(future)
+        future.add_done_callback(self._do_activity_done)
+        return future
+
+    def _do_activity_done(self, future):
+        """Called when the Future of a do-activity is done."""
+        self._do_futures.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            LOG.error('%s - do-activity failed', self,
+                      exc_info=future.exception())
+
+    def count_in(self, state):
+        """Returns the number of instances in which state is active (requires
+           the StateMachine to be created with index=True)."""
+        return len(self._get_index().get(state, ()))
+
+    def instances_in(self, state):
+        """Returns the SMStates of the instances in which state is active
+           (requires the StateMachine to be created with index=True)."""
+        keys = list(self._get_index().get(state, ()))
+        if self._demux is None:
+            return [self._sm_state] if keys else []
+        instances = self._sm_instances
+        return [instances[k] for k in keys if k in instances]
+
+    def active_counts(self):
+        """Returns the number of instances in which each State is active
+           (State -> count, inactive States are left out), e.g. to
+           overlay them on the graph (see graph()).
+
+           The counts are a snapshot taken without stopping the
+           StateMachine, they are approximate while events are being
+           processed. The snapshot only reads the instances (it doesn't
+           allocate their State descriptors), and uses the index of
+           instances by active state when available.
+        """
+        if self._index is not None:
+            # list() copies the items without yielding to other threads
+            return {s: len(keys) for (s, keys) in list(self._index.items())
+                    if keys}
+        if self._demux is None:
+            instances = [self._sm_state]
         else:
-            a_path, b_path = self._lca(a.parent, b.parent)
-            return [a] + a_path, b_path + [b]
+            instances = list(self._sm_instances.values())
+        counts = defaultdict(int)
+        for sm_state in instances:
+            descriptors = sm_state._state
+            if sm_state._stopped or sm_state._finished \
+                    or self._cstate not in descriptors:
+                # not running
+                continue
+            stack = [self._cstate]
+            while stack:
+                state = stack.pop()
+                counts[state] += 1
+                desc = descriptors.get(state)
+                if desc is not None:
+                    stack.extend(s for s in state._active_children(desc)
+                                 if not isinstance(s, PseudoState))
+        return dict(counts)
+
+    def _get_index(self):
+        """Returns the index of instances by active state."""
+        if self._index is None:
+            raise ValueError('%s was not created with index=True' % self)
+        return self._index
 
     def _get_sm_state(self, evt, sm_state=None):
         """Return the SMState (StateMachine instance) the
@@ -334,7 +592,11 @@ class StateMachine(BaseStateMachine):
                 sm_key, evt = self._demux(evt)
                 sm_state = self._sm_instances.get(sm_key)
                 if sm_state is None:
-                    sm_state = SMState(self, key=sm_key)
+                    try:
+                        sm_state = self._pool.pop()
+                        sm_state.reset(sm_key)
+                    except IndexError:
+                        sm_state = SMState(self, key=sm_key)
                     self._sm_instances[sm_key] = sm_state
                     post_init_sm_state(sm_state)
             else:
@@ -344,6 +606,18 @@ class StateMachine(BaseStateMachine):
                 sm_state = self._sm_state
         return sm_state, evt
 
+    @property
+    def _sched(self):
+        """Returns the scheduler of the StateMachine, created on first
+           use."""
+        if self._scheduler is None:
+            import sched
+            if self._v3sched:
+                self._scheduler = sched.scheduler()
+            else:
+                self._scheduler = sched.scheduler(time.time, self._sched_wait)
+        return self._scheduler
+
     def _sched_wait(self, delay):
         """Waits for next scheduled event all the while processing
            potential external events posted to the SM.
@@ -381,12 +655,134 @@ class StateMachine(BaseStateMachine):
             return
         # New event available, process it.
         sm_state, evt = evt
-        {COMPLETION_EVENT: self._process_completion_event,
-         INIT_EVENT: self._process_init_event,
-         STD_EVENT: self._process_std_event, }[prio](sm_state, evt)
+        # event_keys(evt) is computed at most once per dequeued event,
+        # even when it is broadcast (see SMState._may_react)
+        self._keys_evt = None
+        if sm_state is None:
+            self._process_broadcast(evt)
+        elif sm_state._stopped:
+            # Instance terminated, discard the event
+            if evt is _RELEASE:
+                # Other releases may have filled the pool since stop()
+                if len(self._pool) < self.pool_size:
+                    self._pool.append(sm_state)
+            elif prio == STD_EVENT:
+                self._call_processed_hooks(sm_state, evt)
+        elif sm_state._parked is not None and prio != RESUME_EVENT:
+            # Instance waiting for do-activities to stop
+            sm_state._held.append((prio, evt))
+        else:
+            self._dispatch(prio, sm_state, evt)
+        if self._completions:
+            self._process_completions()
+
+    def _process_completions(self):
+        """Processes the completion events raised by the SM thread, in
+           order, until there are none left."""
+        completions = self._completions
+        while completions:
+            sm_state, state = completions.popleft()
+            if sm_state._stopped:
+                continue
+            if sm_state._parked is not None:
+                sm_state._held.append((COMPLETION_EVENT, state))
+            else:
+                self._dispatch(COMPLETION_EVENT, sm_state, state)
+
+    def _dispatch(self, prio, sm_state, evt):
+        """Processes an event of the given type/priority."""
+        try:
+            {RESUME_EVENT: self._process_resume_event,
+             COMPLETION_EVENT: self._process_completion_event,
+             INIT_EVENT: self._process_init_event,
+             DEFERRED_EVENT: self._process_deferred_event,
+             STD_EVENT: self._process_std_event, }[prio](sm_state, evt)
+            if sm_state._do_polls:
+                for state in list(sm_state._do_polls):
+                    state._poll_do_activity(sm_state)
+        except Exception as exc:
+            for hook in self.hooks['error']:
+                h, args, kargs = hook
+                h(sm_state, evt, exc, *args, **kargs)
+            raise
 
     def _process_init_event(self, sm_state, _):
         """Starts the state machine (i.e. initial state is entered)."""
+        if self._demux is None or self._elt_hooks:
+            # The initial configuration can't be copied if hooks
+            # registered with the StateMachine must be called.
+            self._init(sm_state)
+            return
+        template = self._init_template
+        if template is None:
+            template = self._init_template = self._make_init_template()
+        if template:
+            descriptors, completions, active = template
+            if self._index is not None:
+                for s in active:
+                    self._index[s].add(sm_state.key)
+            state = sm_state._state
+            for s, d in descriptors.items():
+                desc = state.get(s)
+                if desc is not None and type(desc) is type(d):
+                    # Descriptor of a reused SMState
+                    desc.copy_from(d)
+                else:
+                    state[s] = d.clone() \
+                        if isinstance(d, _StateDescriptor) else d
+            self._completions.extend((sm_state, s) for s in completions)
+        else:
+            self._init(sm_state)
+
+    def _make_init_template(self):
+        """Enters the initial configuration in a scratch SMState, returns
+           its descriptors and the completion events posted, or False if
+           the initial configuration can't be copied."""
+        if self.pure_init is False or not self._has_pure_init():
+            return False
+        LOG.debug('%s - creating initial configuration template', self)
+        sm_state = SMState(self)
+        sm_state._index = None
+        n = len(self._completions)
+        self._init(sm_state)
+        completions = [self._completions.pop()
+                       for _ in range(len(self._completions) - n)]
+        active = [s for (s, _) in self._cstate.get_active_states(sm_state)
+                  if not isinstance(s, PseudoState)]
+        return (sm_state._state, [s for (_, s) in reversed(completions)],
+                active)
+
+    def _has_pure_init(self):
+        """Returns True if entering the initial configuration has no side
+           effects (see the pure_init argument)."""
+        # pylint: disable=protected-access
+        callbacks = bool(self.pure_init)
+        seen = set()
+        states = [self._cstate]
+        while states:
+            state = states.pop()
+            if state in seen:
+                continue
+            seen.add(state)
+            if not state._has_pure_entry(callbacks):
+                return False
+            if isinstance(state, ParallelState):
+                states.extend(state.children)
+            elif state.initial is not None:
+                states.append(state.initial)
+            if isinstance(state, PseudoState):
+                for t in state.transitions:
+                    if not t._is_pure(callbacks):
+                        return False
+                    # Entering the target enters its ancestors
+                    target = t.target
+                    while target is not None:
+                        states.append(target)
+                        target = target.parent
+        return True
+
+    def _init(self, sm_state):
+        """Enters the initial configuration."""
         # SMState needs to be initialized
         # perform entry into the root region/state
 
@@ -400,23 +796,187 @@ class StateMachine(BaseStateMachine):
         """Make the state machine evolve after completion of <state>."""
         LOG.debug('%s - handling completion of %s', sm_state, state)
         transitions = state.get_enabled_transitions(sm_state, None)
-        self._step(evt=None, sm_state=sm_state, transitions=transitions)
+        self._step(evt=None, sm_state=sm_state, transitions=transitions,
+                   then=(self._completed, state))
+
+    def _completed(self, sm_state, state):
+        """Propagates the completion of <state> once the transitions
+           triggered by the completion have been followed."""
         if state.parent:
             state.parent.child_completed(sm_state, state)
         else:
             # top level region completed.
             state._exit(sm_state)  # pylint: disable=protected-access
+            sm_state._finished = True
             self.stop(sm_state=sm_state)
 
     def _process_std_event(self, sm_state, evt):
         """Make the state machine evolve according to <evt>."""
-        self._step(sm_state, evt, transitions=None)
+        self._process_deferred_event(sm_state, evt)
+        self._call_processed_hooks(sm_state, evt)
+
+    def _call_processed_hooks(self, sm_state, evt):
+        """Calls the 'processed' hooks for evt."""
+        for hook in self.hooks['processed']:
+            h, args, kargs = hook
+            h(sm_state, evt, *args, **kargs)
+
+    def _process_deferred_event(self, sm_state, evt):
+        """Make the state machine evolve according to <evt>, or defer
+           it if it doesn't trigger any transition and an active State
+           defers it. Also used for deferred events that are re-injected
+           once a State deferring them is exited."""
+        transitions = self._cstate.get_enabled_transitions(sm_state, evt)
+        if not transitions and self._deferring \
+                and self._is_deferred(sm_state, evt):
+            LOG.debug('%s - deferring %r', sm_state, evt)
+            sm_state._deferred.append(evt)
+        else:
+            self._step(sm_state, evt, transitions=transitions)
+
+    def _is_deferred(self, sm_state, evt, exclude=None):
+        """Returns True if an active State of sm_state (other than
+           exclude) defers evt."""
+        for state in self._deferring:
+            if state is not exclude and state.defers(sm_state, evt) and \
+                    self._is_active(sm_state, state):
+                return True
+        return False
+
+    @staticmethod
+    def _is_active(sm_state, state):
+        """Returns True if state is active in sm_state."""
+        parent = state.parent
+        while parent is not None:
+            if not isinstance(parent, ParallelState) and \
+                    sm_state.retrieve_state(parent).active_substate \
+                    is not state:
+                return False
+            state, parent = parent, parent.parent
+        return True
+
+    def _process_broadcast(self, bcast):
+        """Dispatches a broadcast event to the selected instances."""
+        evt, where = bcast.evt, bcast.where
+        if self._demux is None:
+            instances = [self._sm_state]
+        elif self._index is not None:
+            evt_keys = event_keys(evt)
+            self._keys_evt, self._evt_keys = evt, evt_keys
+            keys = set()
+            for state, interest in self._reactive:
+                if interest is None or evt_keys is None or \
+                        not interest.isdisjoint(evt_keys):
+                    keys.update(self._index.get(state, ()))
+            instances = [self._sm_instances[k] for k in keys
+                         if k in self._sm_instances]
+        else:
+            instances = list(self._sm_instances.values())
+        for sm_state in instances:
+            if sm_state._stopped:
+                continue
+            if where is not None:
+                if isinstance(where, State):
+                    if not self._is_active(sm_state, where):
+                        continue
+                elif not where(sm_state):
+                    continue
+            if sm_state._parked is not None:
+                sm_state._held.append((STD_EVENT, evt))
+                continue
+            self._dispatch(STD_EVENT, sm_state, evt)
+            if self._completions:
+                self._process_completions()
+
+    def _process_resume_event(self, sm_state, _):
+        """Resumes the step of an instance that waited for do-activities
+           to stop, then processes the events held in the meantime."""
+        parked = sm_state._parked
+        if parked is None:
+            return
+        evt, transitions, then, states = parked
+        # pylint: disable=protected-access
+        if any(s._stop_do_activity_async(sm_state) for s in states):
+            return
+        LOG.debug('%s - resuming step for %r', sm_state, evt)
+        sm_state._parked = None
+        if self._step(sm_state, evt, transitions, then):
+            return
+        held = sm_state._held
+        while held:
+            prio, evt = held.popleft()
+            self._dispatch(prio, sm_state, evt)
+            if self._completions:
+                self._process_completions()
+            if sm_state._parked is not None:
+                return
+        sm_state._held = None
+
+    def _park(self, sm_state, state, only_children, parked):
+        """Requires the running do-activities of the active states under
+           <state> (included unless only_children) to exit without waiting
+           for them. If some are still running, the sm_state is suspended
+           until they stop and True is returned."""
+        # pylint: disable=protected-access
+        states = [s for (s, _) in state.get_active_states(sm_state)
+                  if s.do_activity is not None
+                  and not (only_children and s is state)
+                  and s._stop_do_activity_async(sm_state)]
+        if not states:
+            return False
+        LOG.debug('%s - waiting for do-activities of %s to stop',
+                  sm_state, [str(s) for s in states])
+        sm_state._parked = parked + (states,)
+        if sm_state._held is None:
+            sm_state._held = deque()
+        return True
+
+    @staticmethod
+    def _build_interest(states):
+        """Returns the keys of the events each State and its substates
+           can react to (None if any event), and the States that can react
+           to events (with the keys of their own transitions)."""
+        interest = {}
+        reactive = []
+        # children come after their parent in states
+        for state in reversed(states):
+            if isinstance(state, PseudoState):
+                keys = frozenset()
+            else:
+                keys = _union(t.interest() for t in state.transitions)
+                if state.transitions or state.defer is not None:
+                    reactive.append(
+                        (state, None if state.defer is not None else keys))
+            interest[state] = _union(
+                [keys] + [interest[c] for c in state.children])
+        return interest, reactive
+
+    def freeze(self):
+        """Freezes the State graph of the StateMachine, called by start().
+
+           The States and Transitions of the graph can't be modified
+           once frozen (see State.freeze), which allows the tables used
+           to process events to be computed once and for all: they are
+           shared by all the StateMachines using the same graph (e.g.
+           instances of a StateMachine subclass). Calling freeze() more
+           than once has no effect.
+        """
+        if self._compiled is not None:
+            return
+        from toysm.compiled import CompiledGraph
+        compiled = CompiledGraph.of(self._cstate)
+        if compiled.sm_tables is None:
+            interest, reactive = self._build_interest(compiled.states)
+            deferring = [s for s in compiled.states if s.defer is not None]
+            compiled.sm_tables = interest, reactive, deferring
+        # All States, and those that defer events
+        self._all_states = compiled.states
+        self._interest, self._reactive, self._deferring = compiled.sm_tables
+        self._keys_evt = self._evt_keys = None
+        self._compiled = compiled
 
     def _loop(self):
         """State Machine loop, called by the SM's thread"""
-        # assign dept to each state (to assist LCA calculation)
-        self._assign_depth()
-
         # loop should:
         # - exit when _terminated is True
         # - sleep for MAX_STOP_WAIT at a time
@@ -425,14 +985,21 @@ class StateMachine(BaseStateMachine):
         LOG.debug('%s - beginning event loop', self)
         while not self._terminated:
             # resolve all completion events in priority
+            scheduler = self._scheduler
             if self._v3sched:
-                tm_next_sched = self._sched.run(blocking=False)
+                tm_next_sched = scheduler and scheduler.run(blocking=False)
+                if self._completions:
+                    # may schedule new events, next wake-up is re-evaluated
+                    self._process_completions()
+                    continue
                 if tm_next_sched:
                     tm_next_sched += time.time()
                 self._process_next_event(tm_next_sched)
             else:
-                if not self._sched.empty():
-                    self._sched.run()
+                if scheduler and not scheduler.empty():
+                    scheduler.run()
+                    if self._completions:
+                        self._process_completions()
                 else:
                     self._process_next_event()
             if LOG.isEnabledFor(logging.DEBUG):
@@ -441,13 +1008,30 @@ class StateMachine(BaseStateMachine):
                           self,
                           [e for (_, _, e) in sorted(self._event_queue._queue)])
         LOG.debug('%s - State machine done', self)
+        # Do-activities that haven't started won't be needed, those that
+        # are still running are required to exit.
+        for future in list(self._do_futures):
+            future.cancel()
+        with self._do_lock:
+            for exit_required in self._do_exits:
+                exit_required.set()
+            self._do_exits.clear()
+        if self._executor_workers is not None:
+            # Idle worker threads would otherwise prevent the interpreter
+            # from exiting, a fresh executor allows a restart.
+            self.executor.shutdown(wait=False)
+            self.executor = self._make_executor()
         self._thread = None
 
-    def _step(self, sm_state, evt, transitions=None):
+    def _step(self, sm_state, evt, transitions=None, then=None):
         """Make the StateMachine evolve sm_state according to the evt event.
            If transitions is None, relevant transitions will
            be determined based on the StateMachines current enabled
            transitions for the given event.
+           then is an optional (function, arg) called as
+           function(sm_state, arg) once the step is complete.
+           Returns True if the step was suspended to wait for do-activities
+           to stop (see async_do_exit).
         """
         LOG.debug('%s - processing event %r', sm_state, evt)
         if transitions is None:
@@ -465,7 +1049,7 @@ class StateMachine(BaseStateMachine):
                 continue
             src = t.source
             tgt = t.target or t.source  # if no target is defined, target is self
-            s_path, t_path = self._lca(src, tgt)
+            s_path, t_path = self._compiled.lca(src, tgt)
             if src is not tgt \
                     and t.kind is not Transition._ENTRY \
                     and isinstance(s_path[-1], ParallelState):
@@ -479,6 +1063,10 @@ class StateMachine(BaseStateMachine):
                 only_children = len(s_path) > 1 or t.kind != Transition.EXTERNAL
                 LOG.debug('s_path %s, t_path %s, only_children=%s',
                           s_path, t_path, only_children)
+                if self.async_do_exit and \
+                        self._park(sm_state, s_path[-1], only_children,
+                                   (evt, [t] + transitions, then)):
+                    return True
                 if isinstance(s_path[0], PseudoState):
                     s_path[0]._exit(sm_state)
                 s_path[-1]._exit(sm_state, only_children)
@@ -495,11 +1083,16 @@ class StateMachine(BaseStateMachine):
                 b._enter(sm_state)
 
         LOG.debug("%s - step complete for %r", sm_state, evt)
+        if then is not None:
+            then[0](sm_state, then[1])
+        return False
 
     def __str__(self):
         return 'StateMachine'
 
-    def graph(self, fname=None, fmt=None, prg=None, dot=None):
+    def graph(self, fname=None, fmt=None, prg=None, dot=None,
+              cache_dir=None, root=None, max_depth=None, focus=None,
+              radius=1, heat=None):
         """Generates a graph of the State Machine.
 
         Args:
@@ -510,80 +1103,49 @@ class StateMachine(BaseStateMachine):
                     default to the suffix of fname, or "svg" if no suffix
                     can be determined.
              prg:   Override the program used for graph generation with
-                    a shell command, e.g. prg="dot -Tpng > myfile" or
-                    prg="cat > debug.dot"
+                    a shell command, e.g. prg="dot -Tpng > myfile".
+                    Otherwise dot/xdot are run directly (without a shell).
+                    Use to_dot() to obtain the graph in dot format.
              dot:   graph level directives (see man dot) that will be
                     included verbatim in the graph definition.
+             cache_dir: directory holding previously rendered graphs.
+                    When fname is provided, the graph is only rendered
+                    if it isn't found in cache_dir (i.e. if the graph
+                    or fmt changed since it was last rendered).
+
+        Level of detail options, to render parts of large graphs:
+             root:  State under which the graph is rendered, defaults to
+                    the StateMachine's top-level State.
+             max_depth: composite States at this depth below root
+                    (0 being root) are rendered as single nodes (with a
+                    double border), without their substates. The
+                    Transitions of their substates are redirected to
+                    them.
+             focus: only render the States within radius Transitions
+                    (followed in either direction) of the focus State,
+                    and their ancestors.
+             radius: see focus.
+             heat:  overlays the number of instances in which each State
+                    is active (State -> count, or True for a snapshot of
+                    the running StateMachine, see active_counts()).
+                    Active States are filled with a color going from
+                    white to red with their count, which is added to
+                    their label.
        """
 
-        def write_node(stream, state, transitions=None):
-            """Writes a state's representation in dot format."""
-            transitions.extend(state.transitions)
-            attrs = dot_attrs(state)
-            if state.children:
-                stream.write(_bytes('subgraph cluster_%s {\n' % id(state)))
-                stream.write(_bytes(attrs + "\n"))
-                if state.initial \
-                        and not isinstance(state.initial, InitialState):
-                    i = InitialState()
-                    write_node(stream, i, transitions)
-                    # pylint: disable = protected-access
-                    transitions.append(Transition(source=i,
-                                                  target=state.initial,
-                                                  kind=Transition._ENTRY))
-
-                for c in state.children:
-                    write_node(stream, c, transitions)
-                stream.write(b'}\n')
-            else:
-                stream.write(_bytes('%s [%s]\n' % (id(state), attrs)))
-
-        def find_endpoint_for(node):
-            """Find a substate of a cluster node for the purpose
-               of setting a edge's head/tail.
-               This is linked to the fact that Graphviz doesn't
-               support a 'cluster' as the head/tail of an edge.
-            """
-            if node.children:
-                if node.initial:
-                    node = node.initial
-                else:
-                    node = list(node.children)[0]
-                return find_endpoint_for(node)
-            else:
-                return id(node)
-
-        if fname:
-            fmt = fmt or (fname[-3:] if fname[-4:-3] == '.' else 'svg')
-            cmd = "%s -T%s > %s" % (prg or DOT, fmt, fname)
-        else:
-            cmd = prg or XDOT
-
-        # Go through all states and generate dot to create the graph
-        # with subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE) as proc:
-        proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
-        try:
-            f = proc.stdin
-            transitions = []
-            f.write(b"digraph { compound=true; edge [arrowhead=vee]\n")
-            if dot is not None:
-                f.write(_bytes(dot + "\n"))
-            write_node(f, self._cstate, transitions=transitions)
-            for t in transitions:
-                src, tgt = t.source, t.target or t.source
-                attrs = {}
-                if src.children:
-                    attrs['ltail'] = "cluster_%s" % id(src)
-                src = find_endpoint_for(src)
-                if tgt.children:
-                    attrs['lhead'] = "cluster_%s" % id(tgt)
-                tgt = find_endpoint_for(tgt)
-                f.write(_bytes('%s -> %s [%s]\n' %
-                               (src, tgt, dot_attrs(t, **attrs))))
-            f.write(b"}")
-            f.close()
-        finally:
-            proc.wait()
+        from toysm.graph import graph
+        graph(self, fname, fmt, prg, dot, cache_dir, root=root,
+              max_depth=max_depth, focus=focus, radius=radius, heat=heat)
+
+    def to_dot(self, f=None, dot=None, root=None, max_depth=None,
+               focus=None, radius=1, heat=None):
+        """Returns the graph of the State Machine in dot format, or writes
+           it to f (a text stream) if provided. dot holds graph level
+           directives and the other arguments are level of detail options,
+           see graph()."""
+        from toysm.graph import to_dot
+        return to_dot(self, f, dot, root=root, max_depth=max_depth,
+                      focus=focus, radius=radius, heat=heat)
 
 
 if __name__ == "__main__":
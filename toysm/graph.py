@@ -0,0 +1,372 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# pylint: disable=protected-access
+
+"""
+Graphviz (dot) rendering of StateMachines.
+
+This module is imported on first use by StateMachine.graph() and
+StateMachine.to_dot(), so that importing toysm doesn't import the
+modules it depends on (e.g. subprocess).
+
+Nodes are named after the position of their State in the depth first
+order of the graph (see toysm.compiled), the DOT text of a StateMachine
+is therefore the same from one process to the next.
+"""
+
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+
+from toysm.core import InitialState
+from toysm.compiled import _preorder
+
+# Dot binaries / command lines
+DOT = 'dot'
+XDOT = 'xdot -'
+
+# Size (in characters) of the chunks of DOT text produced by iter_dot
+CHUNK_SIZE = 1 << 16
+
+
+def _quote(value):
+    """Returns the value of a dot attribute as a string, quoted unless
+       it is a HTML-like label."""
+    value = str(value)
+    if not (value.startswith('<') and value.endswith('>')):
+        value = '"%s"' % value.replace('"', r'\"')
+    return value
+
+
+def _compile_attrs(d):
+    """Returns (fmt, callables) for the d dict of dot attributes: the
+       formatted attributes with a %s placeholder for the value of each
+       attribute given by a callable, see _format_attrs."""
+    parts, callables = [], []
+    for (k, v) in d.items():
+        if callable(v):
+            parts.append('%s=%%s' % k)
+            callables.append(v)
+        else:
+            parts.append(('%s=%s' % (k, _quote(v))).replace('%', '%%'))
+    return ';'.join(parts), callables
+
+
+def _format_attrs(obj, compiled):
+    """Returns the dot attributes of obj given the result of
+       _compile_attrs for its dot dict, callables are called with obj."""
+    fmt, callables = compiled
+    return fmt % tuple(_quote(c(obj)) for c in callables)
+
+
+def dot_attrs(obj, **overrides):
+    """Convert 'dot' attributes in a State or Transition for parsing by
+       the dot interpreter.
+    """
+    if overrides:
+        d = obj.dot.copy()
+        d.update(overrides)
+    else:
+        d = obj.dot
+    return _format_attrs(obj, _compile_attrs(d))
+
+
+def _heat_attrs(state, count, top):
+    """Returns the dot attributes overlaying count (the number of
+       instances in which state is active, top being the highest count)
+       on state: its fill color goes from white to red with the count,
+       which is added to its label."""
+    d = state.dot
+    label, style = d.get('label', ''), d.get('style', '')
+    label = label(state) if callable(label) else str(label)
+    style = style(state) if callable(style) else style
+    attrs = {
+        'style': '%s,filled' % style if style else 'filled',
+        'fillcolor': '0.000 %.3f 1.000' % (count / float(top)),
+    }
+    if not label.startswith('<'):
+        # not a HTML-like label
+        attrs['label'] = r'%s\n%i' % (label, count) if label \
+            else str(count)
+    return attrs
+
+
+def _neighbourhood(focus, radius):
+    """Returns the States within radius Transitions (followed in either
+       direction) of the focus State."""
+    selected = {focus}
+    frontier = [focus]
+    for _ in range(radius):
+        reached = []
+        for state in frontier:
+            for t in state.transitions:
+                if t.target is not None and t.target not in selected:
+                    selected.add(t.target)
+                    reached.append(t.target)
+            for t in state.rev_transitions:
+                if t.source not in selected:
+                    selected.add(t.source)
+                    reached.append(t.source)
+        frontier = reached
+    return selected
+
+
+def _iter_lines(sm, dot=None, root=None, max_depth=None, focus=None,
+                radius=1, heat=None):
+    """Yields the lines of the graph of the StateMachine sm in dot
+       format, see iter_dot."""
+    root = root if root is not None else sm._cstate
+    if heat is True:
+        heat = sm.active_counts()
+    top = max(heat.values()) if heat else 0
+    states = _preorder(root)
+    ids = {s: i for (i, s) in enumerate(states)}
+    if focus is not None:
+        # the States close to focus, and their ancestors
+        kept = set()
+        for state in _neighbourhood(focus, radius):
+            while state in ids and state not in kept:
+                kept.add(state)
+                state = state.parent
+    else:
+        kept = ids
+    # Rendered States: clusters (rendered with their substates) and
+    # nodes. Composite States below max_depth, or whose substates are
+    # all out of focus, are rendered as (collapsed) nodes.
+    visible = set()
+    clusters = {}       # cluster -> its first rendered substate
+    depth = {root: 0}
+    for state in states:
+        if state is not root:
+            parent = state.parent
+            if parent not in visible or state not in kept \
+                    or depth[parent] == max_depth:
+                continue
+            depth[state] = depth[parent] + 1
+            clusters.setdefault(parent, state)
+        visible.add(state)
+
+    initial_attrs = dot_attrs(InitialState)
+    # id(dot dict) -> (dot dict, _compile_attrs(dot dict)), dot dicts
+    # are usually class attributes shared by many States/Transitions
+    compiled = {}
+
+    def attrs_of(obj, **overrides):
+        """dot_attrs, with compiled dot dicts."""
+        count = heat.get(obj) if top else None
+        if count:
+            overrides.update(_heat_attrs(obj, count, top))
+        if overrides:
+            return dot_attrs(obj, **overrides)
+        d = obj.dot
+        entry = compiled.get(id(d))
+        if entry is None:
+            entry = compiled[id(d)] = d, _compile_attrs(d)
+        return _format_attrs(obj, entry[1])
+
+    def node_for(state):
+        """Returns the rendered State standing for state (itself or a
+           collapsed ancestor), None if state isn't rendered."""
+        node = state
+        while node not in visible:
+            node = node.parent
+            if node not in ids:
+                return None
+        if node is not state and node in clusters:
+            # state is out of focus
+            return None
+        return node
+
+    endpoints = {}
+
+    def find_endpoint_for(node):
+        """Find a substate of a cluster node for the purpose
+           of setting a edge's head/tail.
+           This is linked to the fact that Graphviz doesn't
+           support a 'cluster' as the head/tail of an edge.
+           Endpoints are memoized for all the clusters traversed.
+        """
+        path = []
+        while node in clusters and node not in endpoints:
+            path.append(node)
+            if node.initial in visible:
+                node = node.initial
+            else:
+                node = clusters[node]
+        endpoint = endpoints.get(node, 's%i' % ids[node])
+        for cluster in path:
+            endpoints[cluster] = endpoint
+        return endpoint
+
+    yield 'digraph { compound=true; edge [arrowhead=vee]\n'
+    if dot is not None:
+        yield dot + '\n'
+    # Go through the rendered States (in depth first order, so a cluster
+    # is closed once the States that follow it are no longer its
+    # descendants) and generate the nodes/clusters
+    open_clusters = []
+    for state in states:
+        if state not in visible:
+            continue
+        while open_clusters and open_clusters[-1] is not state.parent:
+            open_clusters.pop()
+            yield '}\n'
+        if state in clusters:
+            yield 'subgraph cluster_%i {\n%s\n' % (ids[state],
+                                                    attrs_of(state))
+            open_clusters.append(state)
+            if state.initial in visible \
+                    and not isinstance(state.initial, InitialState):
+                # implicit initial state
+                yield 'i%i [%s]\n' % (ids[state], initial_attrs)
+        elif state.children:
+            yield 's%i [%s]\n' % (ids[state],
+                                   attrs_of(state, peripheries=2))
+        else:
+            yield 's%i [%s]\n' % (ids[state], attrs_of(state))
+    for _ in open_clusters:
+        yield '}\n'
+    # then the edges, those of States in collapsed nodes are redirected
+    # to the node (once)
+    redirected = set()
+    for state in states:
+        if state in clusters and state.initial in visible \
+                and not isinstance(state.initial, InitialState):
+            tgt = state.initial
+            attrs = {'lhead': 'cluster_%i' % ids[tgt]} \
+                if tgt in clusters else {}
+            yield 'i%i -> %s [%s]\n' % (ids[state], find_endpoint_for(tgt),
+                                        ';'.join('%s="%s"' % i
+                                                 for i in attrs.items()))
+        for t in state.transitions:
+            src, tgt = t.source, t.target or t.source
+            src_node, tgt_node = node_for(src), node_for(tgt)
+            if src_node is None or tgt_node is None:
+                continue
+            attrs = {}
+            if src_node in clusters:
+                attrs['ltail'] = "cluster_%i" % ids[src_node]
+            if tgt_node in clusters:
+                attrs['lhead'] = "cluster_%i" % ids[tgt_node]
+            line = '%s -> %s [%s]\n' % (find_endpoint_for(src_node),
+                                        find_endpoint_for(tgt_node),
+                                        attrs_of(t, **attrs))
+            if src_node is not src or tgt_node is not tgt:
+                if src_node is tgt_node or line in redirected:
+                    continue
+                redirected.add(line)
+            yield line
+    yield '}'
+
+
+def iter_dot(sm, dot=None, chunk_size=CHUNK_SIZE, **lod):
+    """Yields the graph of the StateMachine sm in dot format, as strings
+       of about chunk_size characters. lod holds the level of detail
+       options of StateMachine.graph (root, max_depth, focus, radius
+       and heat)."""
+    chunk, size = [], 0
+    for line in _iter_lines(sm, dot, **lod):
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def to_dot(sm, f=None, dot=None, **lod):
+    """Returns the graph of the StateMachine sm in dot format, or writes
+       it to f (a text stream), see StateMachine.to_dot."""
+    if f is None:
+        return ''.join(iter_dot(sm, dot, **lod))
+    for chunk in iter_dot(sm, dot, **lod):
+        f.write(chunk)
+
+
+def write_dot(sm, f, dot=None, **lod):
+    """Writes the graph of the StateMachine sm in dot format to f
+       (a binary stream), see graph()."""
+    for chunk in iter_dot(sm, dot, **lod):
+        f.write(chunk.encode('utf-8'))
+
+
+def _render(sm, cmd, dot, lod, shell=False):
+    """Pipes the graph of sm to the cmd command."""
+    proc = subprocess.Popen(cmd, shell=shell, stdin=subprocess.PIPE)
+    try:
+        write_dot(sm, proc.stdin, dot, **lod)
+        proc.stdin.close()
+    finally:
+        status = proc.wait()
+    if status:
+        raise subprocess.CalledProcessError(status, cmd)
+
+
+def graph(sm, fname=None, fmt=None, prg=None, dot=None, cache_dir=None,
+          **lod):
+    """Generates a graph of the StateMachine sm, see StateMachine.graph."""
+    if lod.get('heat') is True:
+        # the same snapshot is hashed and rendered
+        lod['heat'] = sm.active_counts()
+    if prg is not None:
+        # shell command provided by the caller
+        if fname:
+            fmt = fmt or (fname[-3:] if fname[-4:-3] == '.' else 'svg')
+            prg = "%s -T%s > %s" % (prg, fmt, fname)
+        _render(sm, prg, dot, lod, shell=True)
+        return
+    if not fname:
+        _render(sm, shlex.split(XDOT), dot, lod)
+        return
+    fmt = fmt or (fname[-3:] if fname[-4:-3] == '.' else 'svg')
+    if cache_dir is None:
+        _render(sm, shlex.split(DOT) + ['-T%s' % fmt, '-o', fname], dot,
+                lod)
+        return
+    # The DOT text is deterministic (and covers the structure of the
+    # graph as well as the dot attributes of its States/Transitions),
+    # its hash identifies the rendered graph.
+    h = hashlib.sha1(fmt.encode('utf-8'))
+    for chunk in iter_dot(sm, dot, **lod):
+        h.update(chunk.encode('utf-8'))
+    cached = os.path.join(cache_dir, '%s.%s' % (h.hexdigest(), fmt))
+    if not os.path.exists(cached):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            _render(sm, shlex.split(DOT) + ['-T%s' % fmt, '-o', tmp], dot,
+                    lod)
+            os.rename(tmp, cached)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    shutil.copyfile(cached, fname)
+
+# vim:expandtab:sw=4:sts=4
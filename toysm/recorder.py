@@ -0,0 +1,217 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# pylint: disable=protected-access
+
+"""
+Low overhead "flight recorder" for StateMachines.
+
+A FlightRecorder keeps the last N state entries/exits and transitions
+followed by a StateMachine in a preallocated ring buffer. Unlike full
+logging it can be left enabled in production and dumped after the fact,
+e.g. when an exception is raised while processing an event or to
+understand why an instance is stuck.
+"""
+
+from array import array
+import sys
+import time
+
+from toysm.public import public
+
+# Record kinds
+ENTRY = 0
+EXIT = 1
+ACTION = 2
+
+_KIND_NAMES = ('entry', 'exit', 'action')
+
+# Marker used to designate all StateMachine instances
+ALL = object()
+
+
+class _Ring(object):
+    """Fixed size circular buffer of records.
+
+       Records are stored column-wise in preallocated arrays, appending
+       a record never allocates memory (other than the references held
+       on events and instance keys).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.ts = array('d', [0.]) * size
+        self.kind = array('b', [0]) * size
+        self.elt = array('i', [0]) * size
+        self.evt = [None] * size
+        self.key = [None] * size
+
+    def append(self, ts, kind, elt, evt, key):
+        """Adds a record to the ring, overwriting the oldest one if full."""
+        i = self.count % self.size
+        self.ts[i] = ts
+        self.kind[i] = kind
+        self.elt[i] = elt
+        self.evt[i] = evt
+        self.key[i] = key
+        self.count += 1
+
+    def __iter__(self):
+        """Iterates over (ts, kind, elt, evt, key) records, oldest first."""
+        for n in range(max(0, self.count - self.size), self.count):
+            i = n % self.size
+            yield self.ts[i], self.kind[i], self.elt[i], self.evt[i], self.key[i]
+
+
+@public
+class FlightRecorder(object):
+    """Bounded recording of a StateMachine's activity.
+
+       Each record holds a timestamp, the kind of activity (state entry/exit
+       or transition action), the State/Transition involved, the event being
+       processed (for transitions) and the key of the SM instance.
+
+       recorder = FlightRecorder(size=4096).attach(sm)
+       ...
+       recorder.dump()
+    """
+
+    def __init__(self, size=1024, per_instance=False, clock=time.time,
+                 stream=None):
+        """
+        Parameters:
+        size          number of records kept (per instance if per_instance
+                      is set).
+
+        per_instance  if True, each StateMachine instance (see the 'demux'
+                      argument of StateMachine) gets its own ring buffer,
+                      which is released once the instance exits its top-level
+                      state. Otherwise a single buffer is shared by all
+                      instances.
+
+        clock         function returning the timestamp of records.
+
+        stream        file-like object used when records are dumped
+                      because of an exception, defaults to sys.stderr.
+        """
+        self.size = size
+        self.per_instance = per_instance
+        self.clock = clock
+        self.stream = stream
+        self.elements = []      # States/Transitions indexed by record elt
+        self._root = None
+        self._rings = {}
+        self._ring = None if per_instance else _Ring(size)
+
+    def attach(self, sm, dump_on_error=True):
+        """Start recording activity for all States/Transitions of sm. The
+           hooks are registered with sm (see StateMachine.add_state_hook),
+           other StateMachines sharing its State graph aren't recorded.
+
+           If dump_on_error is True, the records of the SM instance will be
+           dumped when an exception occurs while it processes an event.
+           Returns the FlightRecorder.
+        """
+        self._root = sm._cstate
+        states = [sm._cstate]
+        while states:
+            state = states.pop()
+            idx = self._register(state)
+            sm.add_state_hook(state, 'pre_entry', self._record, ENTRY, idx)
+            sm.add_state_hook(state, 'post_exit', self._record, EXIT, idx)
+            for t in state.transitions:
+                sm.add_transition_hook(t, self._record_action,
+                                       self._register(t))
+            states.extend(state.children)
+        if dump_on_error:
+            sm.add_hook('error', self._on_error)
+        return self
+
+    def _register(self, elt):
+        """Returns the index used to identify elt in records."""
+        self.elements.append(elt)
+        return len(self.elements) - 1
+
+    def _get_ring(self, key):
+        """Returns the ring buffer in which to record activity for key."""
+        ring = self._ring
+        if ring is None:
+            ring = self._rings.get(key)
+            if ring is None:
+                ring = self._rings[key] = _Ring(self.size)
+        return ring
+
+    def _record(self, sm, state, kind, idx, evt=None):
+        """State entry/exit hook."""
+        key = sm.key
+        self._get_ring(key).append(self.clock(), kind, idx, evt, key)
+        if kind == EXIT and self._ring is None and state is self._root:
+            # Instance is done, release its ring buffer.
+            del self._rings[key]
+
+    def _record_action(self, sm, _, evt, idx):
+        """Transition hook."""
+        key = sm.key
+        self._get_ring(key).append(self.clock(), ACTION, idx, evt, key)
+
+    def records(self, key=ALL):
+        """Returns a list of (timestamp, kind, element, event, key) records,
+           oldest first. kind is one of 'entry', 'exit' or 'action',
+           element is the State/Transition concerned.
+           If key is provided, only the records of the SM instance with
+           that key are returned.
+        """
+        if self._ring is not None:
+            rings = [self._ring]
+        elif key is ALL:
+            rings = list(self._rings.values())
+        else:
+            rings = [self._rings[key]] if key in self._rings else []
+        elements = self.elements
+        records = [(ts, _KIND_NAMES[kind], elements[elt], evt, k)
+                   for ring in rings
+                   for (ts, kind, elt, evt, k) in ring
+                   if key is ALL or k == key]
+        if len(rings) > 1:
+            records.sort(key=lambda r: r[0])
+        return records
+
+    def dump(self, stream=None, key=ALL):
+        """Writes the records (see FlightRecorder.records) to stream,
+           sys.stderr by default.
+        """
+        stream = stream or self.stream or sys.stderr
+        for (ts, kind, elt, evt, k) in self.records(key):
+            stream.write('%.6f %r %-6s %s%s\n' %
+                         (ts, k, kind, elt,
+                          ' evt=%r' % (evt,) if kind == 'action' else ''))
+
+    def _on_error(self, sm_state, evt, exc):
+        """StateMachine 'error' hook."""
+        stream = self.stream or sys.stderr
+        stream.write('%s - %r raised while processing %r, last records:\n' %
+                     (sm_state, exc, evt))
+        self.dump(stream, key=sm_state.key)
+
+# vim:expandtab:sw=4:sts=4
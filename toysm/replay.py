@@ -0,0 +1,258 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+"""
+Replay of recorded event streams against a StateMachine.
+
+    python -m toysm.replay mypackage.mymodule.MySM events.jsonl
+
+Two stream formats are supported:
+- JSON lines, one record per line:
+      {"evt": <event>, "key": <demux key>, "ts": <timestamp>}
+  "key" and "ts" are optional.
+- a compact binary format: the MAGIC header followed by records made of
+  a 4 byte little endian length and a marshalled (ts, key, evt) tuple
+  (ts and key may be None), see write_records().
+
+If records have keys, the StateMachine is created with a demux function
+that routes each event to the instance of its key.
+
+Events are replayed as fast as possible or, with --pace, at the pace given
+by their timestamps. The throughput and the distribution of the latency
+between posting an event and the end of its processing are reported.
+"""
+
+from __future__ import print_function
+
+import argparse
+from collections import deque
+import importlib
+import json
+import marshal
+import struct
+import sys
+import time
+
+from toysm.fsm import StateMachine
+
+MAGIC = b'TSMR\x01'
+_LEN = struct.Struct('<I')
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def load_object(path):
+    """Returns the object designated by the dotted path
+       'package.module.name' (or 'package.module:name')."""
+    if ':' in path:
+        module, name = path.split(':', 1)
+    else:
+        module, _, name = path.rpartition('.')
+    if not module:
+        raise ValueError('Not a dotted path: %r' % path)
+    obj = importlib.import_module(module)
+    for attr in name.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def _key_demux(evt):
+    """demux function for events posted as (key, evt) tuples."""
+    return evt
+
+
+def make_sm(factory, demux=False):
+    """Returns a StateMachine from factory: a StateMachine instance, a
+       StateMachine class or a callable returning a StateMachine."""
+    if isinstance(factory, StateMachine):
+        if demux and factory._demux is None:
+            raise ValueError('Stream has demux keys but %r has no demux '
+                             'function' % factory)
+        return factory
+    sm = factory(demux=_key_demux) if demux else factory()
+    if not isinstance(sm, StateMachine):
+        raise TypeError('%r is not a StateMachine' % sm)
+    return sm
+
+
+def read_records(stream):
+    """Yields the (ts, key, evt) records of stream (a binary file),
+       the format is detected from the first bytes."""
+    head = stream.read(len(MAGIC))
+    if head == MAGIC:
+        while True:
+            data = stream.read(_LEN.size)
+            if len(data) < _LEN.size:
+                return
+            size, = _LEN.unpack(data)
+            yield marshal.loads(stream.read(size))
+    else:
+        for line in _lines(head, stream):
+            line = line.strip()
+            if line:
+                rec = json.loads(line.decode('utf-8'))
+                yield rec.get('ts'), rec.get('key'), rec['evt']
+
+
+def _lines(head, stream):
+    """Yields the lines of stream, head being the data already read."""
+    rest = stream.readline()
+    yield head + rest
+    for line in stream:
+        yield line
+
+
+def write_records(stream, records, binary=False):
+    """Writes (ts, key, evt) records to stream (a binary file) in the
+       JSON lines or binary format."""
+    if binary:
+        stream.write(MAGIC)
+        for rec in records:
+            data = marshal.dumps(tuple(rec), 2)
+            stream.write(_LEN.pack(len(data)))
+            stream.write(data)
+    else:
+        for ts, key, evt in records:
+            rec = {'evt': evt}
+            if ts is not None:
+                rec['ts'] = ts
+            if key is not None:
+                rec['key'] = key
+            stream.write(json.dumps(rec).encode('utf-8') + b'\n')
+
+
+def _hashable(value):
+    """Converts JSON lists to tuples so that events/keys can be hashed."""
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def percentiles(values, pcts=(50, 90, 99)):
+    """Returns a dict of the pcts percentiles of values (and their max)."""
+    values = sorted(values)
+    res = {'p%i' % p: values[min(len(values) - 1, len(values) * p // 100)]
+           for p in pcts}
+    res['max'] = values[-1]
+    return res
+
+
+def replay(sm, records, pace=False, speed=1., timeout=60.):
+    """Posts the (ts, key, evt) records to sm (which must not be started).
+
+       Args:
+           pace:    if True, events are posted at the pace given by their
+                    timestamps (divided by speed), otherwise as fast as
+                    possible.
+           timeout: maximum time to wait for the last events to be
+                    processed.
+       Returns:
+           A dict with the number of events, the duration of the replay,
+           the throughput and latency percentiles (in microseconds).
+    """
+    posted = deque()
+    latencies = []
+
+    def processed(sm_state, evt):
+        latencies.append(timer() - posted.popleft())
+
+    sm.add_hook('processed', processed)
+    sm.start()
+    try:
+        if not sm.settle(timeout):
+            raise RuntimeError('%s failed to start' % sm)
+        demux = sm._demux is not None
+        t0 = timer()
+        ts0 = None
+        for ts, key, evt in records:
+            evt = _hashable(evt)
+            if pace and ts is not None:
+                if ts0 is None:
+                    ts0 = ts
+                delay = t0 + (ts - ts0) / speed - timer()
+                if delay > 0:
+                    time.sleep(delay)
+            posted.append(timer())
+            sm.post((_hashable(key), evt) if demux else evt)
+        if not sm.settle(timeout):
+            raise RuntimeError('%s failed to process all events' % sm)
+        duration = timer() - t0
+    finally:
+        sm.stop()
+        sm.join(1)
+    res = {'events': len(latencies), 'duration': duration,
+           'events_per_sec': len(latencies) / duration if duration else 0.}
+    if latencies:
+        res.update(('latency_%s_us' % k, v * 1e6)
+                   for (k, v) in percentiles(latencies).items())
+    return res
+
+
+def parse_args(argv):
+    """Parses the arguments of the replay command line."""
+    parser = argparse.ArgumentParser(
+        prog='python -m toysm.replay',
+        description='Replay a recorded event stream against a StateMachine.')
+    parser.add_argument('sm',
+                        help='dotted path of the StateMachine class (or of '
+                             'a StateMachine or a function returning one)')
+    parser.add_argument('stream',
+                        help="recorded event stream ('-' for stdin)")
+    parser.add_argument('--pace', action='store_true',
+                        help='replay events at their recorded pace')
+    parser.add_argument('--speed', type=float, default=1.,
+                        help='speed up factor used with --pace (default: '
+                             '%(default)s)')
+    parser.add_argument('--timeout', type=float, default=60.,
+                        help='time allowed to process the last events '
+                             '(default: %(default)s)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Entry point of python -m toysm.replay."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.stream == '-':
+        stream = getattr(sys.stdin, 'buffer', sys.stdin)
+        records = list(read_records(stream))
+    else:
+        with open(args.stream, 'rb') as stream:
+            records = list(read_records(stream))
+    demux = any(key is not None for (_, key, _) in records)
+    sm = make_sm(load_object(args.sm), demux=demux)
+    res = replay(sm, records, pace=args.pace, speed=args.speed,
+                 timeout=args.timeout)
+    if args.json:
+        print(json.dumps(res, indent=2, sort_keys=True))
+    else:
+        for name, value in sorted(res.items()):
+            print('%-20s %14.6g' % (name, value))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim:expandtab:sw=4:sts=4
@@ -0,0 +1,86 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import json
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from toysm import *
+from toysm.chrome_trace import ChromeTrace
+
+
+class TestChromeTrace(unittest.TestCase):
+    def run_sm(self, sm, *evts, **kargs):
+        out = StringIO()
+        trace = ChromeTrace(out, buffer_size=kargs.get('buffer_size', 512))
+        trace.attach(sm)
+        sm.start()
+        sm.post(*evts)
+        sm.settle(.1)
+        sm.stop()
+        self.assertTrue(sm.join(1))
+        trace.close()
+        return json.loads(out.getvalue())
+
+    def test_nested_slices(self):
+        s11 = State('s11')
+        s1 = State('s1', s11 >> 'a' >> State('s12'))
+        sm = StateMachine(s1 >> EqualsTransition('b', desc='to s2')
+                          >> State('s2'))
+        events = self.run_sm(sm, 'a', 'b', buffer_size=1)
+        slices = {e['name']: e for e in events if e['ph'] == 'X'}
+        self.assertIn('{State-s1}-[b/to s2]->{State-s2}', slices)
+        self.assertEqual("'b'",
+                         slices['{State-s1}-[b/to s2]->{State-s2}']
+                         ['args']['evt'])
+        # s11 slice nested in s1's
+        s1_slice, s11_slice = slices['{State-s1}'], slices['{State-s11}']
+        self.assertTrue(s1_slice['ts'] <= s11_slice['ts'])
+        self.assertTrue(s11_slice['ts'] + s11_slice['dur'] <=
+                        s1_slice['ts'] + s1_slice['dur'])
+        # s2 still active when the trace is closed
+        self.assertIn('{State-s2}', slices)
+
+    def test_tracks(self):
+        p = ParallelState('p')
+        r1 = State('r1', State('s1') >> 'a' >> FinalState(), parent=p)
+        r2 = State('r2', State('s2') >> 'a' >> FinalState(), parent=p)
+        sm = StateMachine(State('s0') >> 'b' >> p,
+                          demux=lambda event: (event[0], event[1]))
+        events = self.run_sm(sm, (1, 'b'), (2, 'b'), (1, 'a'))
+        names = {e['args']['name'] for e in events if e['ph'] == 'M'}
+        self.assertEqual({'SM key=1', 'SM key=2'}, names)
+        tids = {e['name']: e['tid'] for e in events if e['ph'] == 'X'}
+        self.assertEqual(tids['{ParallelState-p}'], tids['{State-s0}'])
+        self.assertNotEqual(tids['{ParallelRegion-r1}'],
+                            tids['{ParallelRegion-r2}'])
+        self.assertEqual(tids['{ParallelRegion-r1}'], tids['{State-s1}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab:sw=4:sts=4
@@ -21,8 +21,15 @@
 #
 ################################################################################
 
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 import time
+import threading
 
 import logging
 
@@ -32,6 +39,8 @@ LOG_LEVEL = logging.INFO
 logging.basicConfig(level=LOG_LEVEL)
 
 from toysm import *
+from toysm.fsm import SMState, COMPLETION_EVENT
+from toysm.compiled import CompiledGraph
 from sm_trace import *
 
 
@@ -49,12 +58,13 @@ class TestFSM(unittest.TestCase):
         s2 = State(parent=s1, initial=True)
         s3 = State(parent=s1)
         sm = StateMachine(s1)
-        sm._assign_depth()
+        sm.freeze()
+        lca = sm._compiled.lca
 
-        self.assertEqual(([s1],[s1, s3]), sm._lca(s1, s3))
-        self.assertEqual(([s2, s1],[s1]), sm._lca(s2, s1))
-        self.assertEqual(([s2, s1],[s1, s3]), sm._lca(s2, s3))
-        self.assertEqual(([s2],[s2]), sm._lca(s2, s2))
+        self.assertEqual(([s1],[s1, s3]), lca(s1, s3))
+        self.assertEqual(([s2, s1],[s1]), lca(s2, s1))
+        self.assertEqual(([s2, s1],[s1, s3]), lca(s2, s3))
+        self.assertEqual(([s2],[s2]), lca(s2, s2))
 
     def test_lca2(self):
         '''
@@ -78,11 +88,12 @@ class TestFSM(unittest.TestCase):
         s8 = State(parent=s5)
 
         sm = StateMachine(s1)
-        sm._assign_depth()
+        sm.freeze()
+        lca = sm._compiled.lca
 
-        self.assertEqual(([s3,s2,s1],[s1, s5, s6, s7]), sm._lca(s3, s7))
-        self.assertEqual(([s3,s2],[s2, s4]), sm._lca(s3, s4))
-        self.assertEqual(([s4,s2,s1],[s1,s5,s8]), sm._lca(s4,s8))
+        self.assertEqual(([s3,s2,s1],[s1, s5, s6, s7]), lca(s3, s7))
+        self.assertEqual(([s3,s2],[s2, s4]), lca(s3, s4))
+        self.assertEqual(([s4,s2,s1],[s1,s5,s8]), lca(s4,s8))
 
 
     def test_simple(self):
@@ -1089,6 +1100,173 @@ class TestDemux(unittest.TestCase):
         sm.stop()
         self.assertTrue(sm.join(2 * StateMachine.MAX_STOP_WAIT))
         
+    def test_init_template(self):
+        '''New instances are copied from the initial configuration when
+           entering it has no side effects.'''
+        s11 = State('s11')
+        s21 = State('s21')
+        s1 = State('s1', s11 >> 'a' >> FinalState())
+        s2 = State('s2', s21 >> 'a' >> FinalState())
+        p = ParallelState('p')
+        s1.set_parent(p)
+        s2.set_parent(p)
+        s3 = State('s3', FinalState())
+        s4 = State('s4')
+        sm = StateMachine(p >> s3 >> s4 >> 'b' >> FinalState(),
+                          demux=lambda event: event)
+        sm.start()
+        sm.post((1, 'a'), (2, 'x'))
+        sm.settle(.1)
+        self.assertTrue(sm._init_template)
+        # instance 1 went through s3 (completed on entry) to s4
+        self.assertEqual([s4], [s for (s, _) in sm._cstate.get_active_states(
+                          sm._sm_instances[1])][1:])
+        states = [s for (s, _) in sm._cstate.get_active_states(
+                  sm._sm_instances[2])]
+        self.assertEqual({s11, s21}, set(states) & {s11, s21, s4})
+        sm.post((1, 'b'))
+        sm.settle(.1)
+        self.assertEqual([2], list(sm._sm_instances))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_init_template_callbacks(self):
+        '''Entry callbacks are only called once if declared free of side
+           effects.'''
+        entries = []
+        for pure_init, expected in ((None, 3), (True, 1)):
+            del entries[:]
+            s1 = State('s1', on_enter=lambda sm, state: entries.append(sm))
+            sm = StateMachine(s1 >> 'a' >> State('s2'),
+                              demux=lambda event: event,
+                              pure_init=pure_init)
+            sm.start()
+            sm.post((1, 'b'), (2, 'b'), (3, 'b'))
+            sm.settle(.1)
+            sm.stop()
+            self.assertTrue(sm.join(.2))
+            self.assertEqual(expected, len(entries))
+            self.assertEqual(bool(pure_init), bool(sm._init_template))
+
+    def test_pool(self):
+        '''Terminated instances are reused for new ones.'''
+        instances = set()
+        s11 = State('s11')
+        s1 = State('s1', s11 >> 'a' >> FinalState())
+        sm = StateMachine(s1 >> 'b' >> State('s2') >> 'c' >> FinalState(),
+                          demux=lambda event: event, pool_size=2)
+        sm.add_hook('processed',
+                    lambda sm_state, evt: instances.add(sm_state))
+        sm.start()
+        for i in range(10):
+            sm.post((i, 'b'), (i, 'c'), (i, 'c'))
+            sm.settle(.1)
+        self.assertEqual(1, len(instances))
+        self.assertEqual({}, sm._sm_instances)
+        # Reused instances start from a clean initial configuration
+        sm.post((10, 'x'))
+        sm.settle(.1)
+        sm_state = sm._sm_instances[10]
+        self.assertIn(sm_state, instances)
+        self.assertEqual([s1, s11], [s for (s, _) in
+                         sm._cstate.get_active_states(sm_state)][1:])
+        # The pool stays bounded when many instances terminate at once
+        sm.post(*[(k, e) for k in range(100, 600) for e in ('b', 'c', 'c')])
+        sm.settle(.5)
+        self.assertEqual(2, len(sm._pool))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_index(self):
+        '''Index of instances by active state.'''
+        for on_enter in (None, lambda sm, state: None):
+            s11 = State('s11', on_enter=on_enter)
+            s1 = State('s1', s11 >> 'a' >> State('s12'))
+            s2 = State('s2')
+            sm = StateMachine(s1 >> 'b' >> s2 >> 'c' >> FinalState(),
+                              demux=lambda event: event, index=True)
+            sm.start()
+            sm.post(*[(k, 'a') for k in range(3)] +
+                    [(k, 'b') for k in range(5, 8)] + [(9, 'x'), (7, 'c')])
+            sm.settle(.1)
+            self.assertEqual(4, sm.count_in(s1))
+            self.assertEqual(1, sm.count_in(s11))
+            self.assertEqual(2, sm.count_in(s2))
+            self.assertEqual({5, 6}, {i.key for i in sm.instances_in(s2)})
+            self.assertEqual([9], [i.key for i in sm.instances_in(s11)])
+            sm._sm_instances[9].stop()
+            sm.settle(.1)
+            self.assertEqual(0, sm.count_in(s11))
+            self.assertEqual(3, sm.count_in(s1))
+            sm.stop()
+            self.assertTrue(sm.join(.2))
+
+    def test_completion_order(self):
+        '''A chain of completion transitions (through a Junction) is
+           followed before events queued for other instances.'''
+        entered = []
+
+        def on_enter(sm, state):
+            entered.append((sm.key, state.name))
+        s0, s1, s2, s3 = [State('s%i' % i, on_enter=on_enter)
+                          for i in range(4)]
+        j = Junction()
+        s1 >> s2 >> j
+        j >> s3
+        sm = StateMachine(s0 >> 'go' >> s1, s2, j, s3,
+                          demux=lambda event: event)
+        sm.start()
+        sm.post((1, 'x'), (2, 'x'))
+        sm.settle(.1)
+        del entered[:]
+        sm.post((1, 'go'), (2, 'go'))
+        sm.settle(.1)
+        self.assertEqual([(1, 's1'), (1, 's2'), (1, 's3'),
+                          (2, 's1'), (2, 's2'), (2, 's3')], entered)
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_broadcast(self):
+        '''Event broadcast to all/selected instances.'''
+        s1, s2 = State('s1'), State('s2')
+        sm = StateMachine(s1 >> 'a' >> s2 >> 'b' >> s1,
+                          demux=lambda event: event)
+        sm.start()
+        sm.post(*[(k, 'x') for k in range(4)] + [(3, 'a')])
+        sm.broadcast('a')
+        sm.settle(.1)
+        # the class' name -> State dict isn't shadowed
+        self.assertNotIn('_states', vars(sm))
+        self.assertTrue(all(sm._is_active(i, s2)
+                            for i in sm._sm_instances.values()))
+        sm.post((0, 'b'))
+        sm.broadcast('a', where=s1)
+        sm.broadcast('b', where=lambda sm_state: sm_state.key % 2)
+        sm.settle(.1)
+        self.assertEqual({0, 2}, {k for k, i in sm._sm_instances.items()
+                                  if sm._is_active(i, s2)})
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_broadcast_index(self):
+        '''Broadcast skips indexed instances that can't react.'''
+        s1, s2 = State('s1'), State('s2')
+        sm = StateMachine(s1 >> 'a' >> s2 >> 'b' >> s1,
+                          demux=lambda event: event, index=True)
+        processed = []
+        sm.add_hook('processed', lambda sm_state, evt:
+                    processed.append((sm_state.key, evt)))
+        sm.start()
+        sm.post(*[(k, 'x') for k in range(4)] + [(1, 'a'), (2, 'a')])
+        sm.settle(.1)
+        del processed[:]
+        sm.broadcast('b')
+        sm.settle(.1)
+        self.assertEqual([1, 2], sorted(k for k, _ in processed))
+        self.assertEqual(4, sm.count_in(s1))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
 class TestDoActivity(unittest.TestCase):
     def setUp(self):
         Trace.clear()
@@ -1255,6 +1433,708 @@ class TestDoActivity(unittest.TestCase):
         self.assertTrue(Trace.contains([(fs, 'entry')]))
         self.assertTrue(Trace.contains([(p1, 'done do-activity')]))
 
+    def test_executor(self):
+        '''Do-activities run by a bounded executor keep the exit_required
+           and completion semantics.'''
+        threads = set()
+        def do_trace(sm, state, ex_req):
+            threads.add(threading.current_thread())
+            Trace.add(state, 'do')
+            ex_req.wait(1)
+        s1 = State('s1', do=do_trace)
+        s2 = State('s2', do=do_trace)
+        trace((s1, s2))
+        sm = StateMachine(s1 >> 'a' >> s2 >> 'b' >> s1 >> 'c' >> FinalState(),
+                          executor=1)
+        sm.start()
+        for _ in range(5):
+            sm.post('a', 'b')
+        sm.post('c')
+        self.assertTrue(sm.join(1))
+        # do-activities of States exited before the executor could start
+        # them are cancelled.
+        self.assertTrue(Trace.contains(
+            [(s1, 'exit'), (s2, 'entry'), (s2, 'exit')] * 5 +
+            [(s1, 'exit')]))
+        self.assertTrue(Trace.contains([(s1, 'do')]))
+        self.assertEqual(1, len(threads))
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_executor_cancel(self):
+        '''Pending do-activities are cancelled when the SM stops.'''
+        def do_trace(sm, state, ex_req):
+            Trace.add(state, 'do')
+            ex_req.wait(.5)
+        s1 = State('s1', do=do_trace)
+        s2 = State('s2', do=do_trace)
+        sm1 = StateMachine(s1 >> 'a' >> FinalState(), executor=1)
+        sm2 = StateMachine(s2 >> 'a' >> FinalState(), executor=sm1.executor)
+        sm1.start()
+        sm1.settle(.1)
+        sm2.start()
+        sm2.settle(.1)
+        sm2.stop()
+        self.assertTrue(sm2.join(.2))
+        sm1.post('a')
+        self.assertTrue(sm1.join(.2))
+        time.sleep(.1)
+        self.assertTrue(Trace.contains([(s1, 'do')]))
+        self.assertFalse(Trace.contains([(s2, 'do')], show_on_fail=False))
+
+    def test_do_completion_queued(self):
+        '''Completions posted from a do-activity thread go through the
+           event queue.'''
+        s1 = State('s1', do=lambda sm, state, ex_req: False)
+        s2 = State('s2')
+        sm = StateMachine(s1 >> s2)
+        queued = []
+        put = sm._event_queue.put
+
+        def recording_put(item, prio=None):
+            if prio == COMPLETION_EVENT:
+                queued.append((item[1], threading.current_thread()))
+            return put(item, prio)
+        sm._event_queue.put = recording_put
+        trace((s1, s2))
+        sm.start()
+        sm.settle(.1)
+        self.assertTrue(Trace.contains([(s1, 'exit'), (s2, 'entry')]))
+        self.assertEqual([s1], [state for (state, _) in queued])
+        self.assertIsNot(sm._thread, queued[0][1])
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_executor_stop(self):
+        '''Running do-activities are required to exit when the SM stops
+           and the executor it created is shut down.'''
+        done = threading.Event()
+
+        def do_wait(sm, state, ex_req):
+            ex_req.wait()
+            done.set()
+        s1 = State('s1', do=do_wait)
+        sm = StateMachine(s1 >> 'a' >> FinalState(), executor=2)
+        executor = sm.executor
+        sm.start()
+        sm.settle(.1)
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+        self.assertTrue(done.wait(.5))
+        self.assertRaises(RuntimeError, executor.submit, lambda: None)
+
+    def test_generator(self):
+        '''Generator do-activity waiting for delays and conditions.'''
+        flag = []
+        def do_trace(sm, state):
+            Trace.add(state, 'do-start')
+            yield .1
+            Trace.add(state, 'do-delay')
+            yield lambda: flag
+            Trace.add(state, 'do-cond')
+        s11 = State('s11')
+        s1 = State('s1', s11 >> 'a' >> FinalState(), do=do_trace)
+        fs = FinalState()
+        trace((s1, s11, fs))
+        sm = StateMachine(s1 >> fs)
+        sm.start()
+        sm.settle(.05)
+        self.assertTrue(Trace.contains([(s1, 'entry'), (s1, 'do-start')]))
+        self.assertFalse(Trace.contains([(s1, 'do-delay')],
+                                        show_on_fail=False))
+        time.sleep(.1)
+        sm.post('a')
+        sm.settle(.05)
+        self.assertTrue(Trace.contains([(s1, 'do-delay')]))
+        self.assertTrue(Trace.contains([(s11, 'exit')]))
+        self.assertFalse(Trace.contains([(s1, 'do-cond')],
+                                        show_on_fail=False))
+        flag.append(True)
+        sm.post('b')
+        self.assertTrue(sm.join(.2))
+        self.assertTrue(Trace.contains([(s1, 'do-cond'), (s1, 'exit'),
+                                        (fs, 'entry')]))
+
+    def test_generator_exit(self):
+        '''Generator do-activity is closed when its State is exited.'''
+        def do_trace(sm, state):
+            try:
+                while True:
+                    Trace.add(state, 'do', key=sm.key)
+                    yield 10
+            finally:
+                Trace.add(state, 'do-closed', key=sm.key)
+        s1 = State('s1', do=do_trace)
+        s2 = State('s2')
+        trace((s1,))
+        sm = StateMachine(s1 >> 'a' >> s2 >> 'a' >> s1 >> 'b' >> FinalState(),
+                          demux=lambda evt: evt)
+        sm.start()
+        sm.post((1, 'a'), (1, 'a'), (2, 'b'))
+        sm.settle(.1)
+        self.assertTrue(Trace.contains(
+            [(s1, 'do'), (s1, 'do-closed'), (s1, 'exit'), (s1, 'entry'),
+             (s1, 'do')], key=1))
+        self.assertTrue(Trace.contains(
+            [(s1, 'do'), (s1, 'do-closed'), (s1, 'exit')], key=2))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+        # No pending wake-ups for the exited do-activities
+        self.assertEqual(1, len(sm._sched.queue))
+
+    def test_generator_error(self):
+        '''A failing generator do-activity is reported to the 'error'
+           hooks, its instance and the others keep being processed.'''
+        def do_fail(sm, state):
+            yield .05
+            if sm.key == 1:
+                raise ValueError('failed')
+            yield 10
+        errors = []
+        s1 = State('s1', do=do_fail)
+        s2 = State('s2')
+        trace((s1, s2))
+        sm = StateMachine(s1 >> 'a' >> s2, demux=lambda evt: evt)
+        sm.add_hook('error', lambda sm_state, evt, exc:
+                    errors.append((sm_state.key, evt, str(exc))))
+        sm.start()
+        sm.post((1, 'x'), (2, 'x'))
+        time.sleep(.1)
+        sm.post((1, 'a'), (2, 'a'))
+        sm.settle(.1)
+        self.assertEqual([(1, None, 'failed')], errors)
+        for key in (1, 2):
+            self.assertTrue(Trace.contains([(s1, 'exit'), (s2, 'entry')],
+                                           key=key))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_async_exit(self):
+        '''With async_do_exit, other instances keep being processed while
+           a do-activity winds down, the exiting instance's events are
+           processed in order once it stopped.'''
+        delay = .3
+        def do_trace(sm, state, ex_req):
+            if sm.key == 1:
+                time.sleep(delay)
+            Trace.add(state, 'do-done', key=sm.key)
+        s1 = State('s1', do=do_trace)
+        s2 = State('s2')
+        s3 = State('s3')
+        trace((s1, s2, s3))
+        sm = StateMachine(s1 >> 'a' >> s2 >> 'b' >> s3,
+                          demux=lambda evt: evt, async_do_exit=True)
+        sm.start()
+        sm.settle(.1)
+        sm.post((1, 'a'), (1, 'b'), (2, 'a'))
+        sm.settle(.1)
+        self.assertTrue(Trace.contains([(s1, 'exit'), (s2, 'entry')], key=2))
+        self.assertFalse(Trace.contains([(s1, 'exit')], key=1,
+                                        show_on_fail=False))
+        # wait for the resumed instance to reach s3 (timing independent)
+        deadline = time.time() + 2
+        while time.time() < deadline and not Trace.contains(
+                [(s3, 'entry')], key=1, show_on_fail=False):
+            time.sleep(.01)
+        self.assertTrue(Trace.contains(
+            [(s1, 'entry'), (s1, 'do-done'), (s1, 'exit'), (s2, 'entry'),
+             (s2, 'exit'), (s3, 'entry')], strict=True, key=1))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_async_exit_completion(self):
+        '''Completion handling is resumed once the do-activities of the
+           completed State's children have stopped.'''
+        def do_trace(sm, state, ex_req):
+            ex_req.wait()
+            time.sleep(.1)
+            Trace.add(state, 'do-done')
+        s11 = State('s11', do=do_trace)
+        s1 = State('s1', s11 >> 'a' >> FinalState())
+        s2 = State('s2', State('s21', do=do_trace) >> 'a' >> FinalState())
+        p = ParallelState('p')
+        s1.set_parent(p)
+        s2.set_parent(p)
+        fs = FinalState()
+        trace((s11, p, fs))
+        sm = StateMachine(p >> fs, executor=2, async_do_exit=True)
+        sm.start()
+        sm.post('a')
+        self.assertTrue(sm.join(1))
+        self.assertTrue(Trace.contains(
+            [(s11, 'do-done'), (s11, 'exit'), (p, 'exit'), (fs, 'entry')]))
+
+class TestDeferral(unittest.TestCase):
+    def setUp(self):
+        Trace.clear()
+
+    def test_defer(self):
+        '''Deferred events are processed in order once the State deferring
+           them is exited, before events posted afterwards.'''
+        s1 = State('s1', defer=['x', 'y'])
+        s2 = State('s2')
+        s3 = State('s3')
+        s4 = State('s4')
+        trace((s1, s2, s3, s4))
+        sm = StateMachine(s1 >> 'a' >> s2 >> 'x' >> s3 >> 'y' >> s4
+                          >> 'z' >> s1)
+        sm.start()
+        sm.post('x', 'z', 'y', 'a', 'z')
+        sm.settle(.1)
+        self.assertTrue(Trace.contains(
+            [(s1, 'entry'), (s1, 'exit'), (s2, 'entry'), (s2, 'exit'),
+             (s3, 'entry'), (s3, 'exit'), (s4, 'entry'), (s4, 'exit'),
+             (s1, 'entry')], strict=True))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_defer_nested(self):
+        '''Events stay deferred as long as an active State defers them,
+           transitions take precedence over deferral.'''
+        s11 = State('s11')
+        s12 = State('s12')
+        s1 = State('s1', s11 >> 'a' >> s12,
+                   defer=lambda sm, evt: evt.startswith('x'))
+        s2 = State('s2')
+        s3 = State('s3')
+        trace((s1, s11, s12, s2, s3))
+        s12 >> 'x2' >> s2
+        sm = StateMachine(s1 >> 'b' >> s2 >> 'x1' >> s3)
+        sm.start()
+        sm.post('x1', 'a')
+        sm.settle(.1)
+        self.assertTrue(Trace.contains([(s12, 'entry')]))
+        self.assertFalse(Trace.contains([(s12, 'exit')], show_on_fail=False))
+        sm.post('x2')
+        sm.settle(.1)
+        self.assertTrue(Trace.contains(
+            [(s12, 'exit'), (s1, 'exit'), (s2, 'entry'), (s2, 'exit'),
+             (s3, 'entry')]))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_defer_nested_order(self):
+        '''Events deferred by nested States are re-injected in order of
+           arrival once no active State defers them.'''
+        handled = []
+
+        def handle(sm, evt):
+            handled.append(evt)
+        c1 = State('c1', defer=['x'])
+        c2 = State('c2')
+        p = State('p', c1 >> 'a' >> c2, defer=['x', 'y'])
+        q = State('q')
+        q >> Transition(lambda sm, evt: evt in ('x', 'y'), handle,
+                        kind=Transition.INTERNAL)
+        sm = StateMachine(p >> 'b' >> q)
+        sm.start()
+        sm.post('x', 'y', 'a', 'b')
+        sm.settle(.1)
+        self.assertEqual(['x', 'y'], handled)
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+
+class TestInterest(unittest.TestCase):
+    def setUp(self):
+        Trace.clear()
+
+    def test_skip_regions(self):
+        '''Regions that can't react to an event are not evaluated.'''
+        evaluated = []
+
+        class CountingTransition(EqualsTransition):
+            def _is_triggered(self, sm, evt):
+                if evt is not None:
+                    evaluated.append(self.value)
+                return super(CountingTransition, self)._is_triggered(sm, evt)
+
+        p = ParallelState('p')
+        s1, s2 = State('s1'), State('s2')
+        State('r1', s1 >> CountingTransition('a') >> State('s3'), parent=p)
+        State('r2', s2 >> CountingTransition('b') >> State('s4'), parent=p)
+        trace((s1, s2))
+        sm = StateMachine(p)
+        sm.start()
+        sm.post('b', 'c')
+        sm.settle(.1)
+        self.assertEqual(['b'], evaluated)
+        self.assertTrue(Trace.contains([(s2, 'exit')]))
+        self.assertFalse(Trace.contains([(s1, 'exit')], show_on_fail=False))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_event_types(self):
+        '''Transitions declaring event types only see those events.'''
+        seen = []
+
+        def trigger(sm, evt):
+            seen.append(evt)
+            return evt > 2
+
+        s1, s2 = State('s1'), State('s2')
+        trace((s1, s2))
+        sm = StateMachine(s1 >> Transition(trigger=trigger, event_types=(int,))
+                          >> s2)
+        sm.start()
+        sm.post('x', 1, 3.5, 3)
+        sm.settle(.1)
+        self.assertEqual([1, 3], seen)
+        self.assertTrue(Trace.contains([(s2, 'entry')]))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_event_keys(self):
+        '''Keys of events.'''
+        class Evt(object):
+            __hash__ = None
+
+            def __init__(self, name):
+                self.name = name
+
+        self.assertTrue({'a', str, object} <= event_keys('a'))
+        self.assertIsNone(event_keys(['a']))
+        self.assertIsNone(event_keys(Evt('a')))
+        keys = lambda evt: [evt.name]
+        add_event_keys(Evt, keys)
+        self.addCleanup(remove_event_keys, Evt, keys)
+        self.assertEqual({'a', Evt, object}, event_keys(Evt('a')))
+
+    def test_redefined_matching(self):
+        '''Subclasses redefining is_triggered aren't skipped based on
+           their parent's interest.'''
+        class Prefix(EqualsTransition):
+            def is_triggered(self, sm, evt):
+                return evt is not None and evt.startswith(self.value)
+
+        class AnyTimeout(Timeout):
+            def is_triggered(self, sm, evt):
+                return evt == 'timeout'
+
+        s1, s2, s3 = State('s1'), State('s2'), State('s3')
+        trace((s1, s2, s3))
+        sm = StateMachine(s1 >> Prefix('go') >> s2
+                          >> AnyTimeout(3600) >> s3)
+        sm.start()
+        sm.post('go-now', 'timeout')
+        sm.settle(.1)
+        self.assertTrue(Trace.contains([(s2, 'entry'), (s3, 'entry')]))
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+
+class TestFreeze(unittest.TestCase):
+    def setUp(self):
+        Trace.clear()
+
+    def test_frozen(self):
+        '''The graph can't be modified once the StateMachine is started.'''
+        s1, s2 = State('s1'), State('s2')
+        t = EqualsTransition('a')
+        s1 >> t >> s2
+        sm = StateMachine(s1, s2)
+        sm.start()
+        self.assertIsInstance(s1.transitions, tuple)
+        self.assertIsInstance(s2.rev_transitions, tuple)
+        self.assertIsInstance(sm._cstate.children, tuple)
+        self.assertRaises(IllFormedException, lambda: s1 >> 'b' >> s2)
+        self.assertRaises(IllFormedException, State, 's3', parent=s1)
+        self.assertRaises(IllFormedException, s1.add_hook, 'entry',
+                          lambda sm, s: None)
+        self.assertRaises(IllFormedException, t.add_hook,
+                          lambda sm, t, evt: None)
+        sm.post('a')
+        sm.settle(.1)
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+        # Restarting doesn't require unfrozen States
+        sm.start()
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+
+    def test_copies_not_frozen(self):
+        '''Copies of a started StateMachine's class graph can be
+           modified.'''
+        class C(StateMachine):
+            i = InitialState()
+            s1 = State()
+            i >> s1
+
+        c = C()
+        c.start()
+        c.stop()
+        self.assertTrue(c.join(.2))
+
+        class D(C):
+            s2 = State()
+            C.s1 >> 'a' >> s2
+
+        self.assertEqual(['a'], [t.desc for t in D._states['s1'].transitions])
+
+    def test_region_order(self):
+        '''Regions of a ParallelState are entered and exited in the order
+           they were created.'''
+        p = ParallelState('p')
+        regions = [State('r%i' % i, parent=p) for i in range(20)]
+        for r in regions:
+            State(parent=r, initial=True)
+        trace(regions)
+        sm = StateMachine(p)
+        sm.start()
+        sm.settle(.1)
+        sm.stop()
+        self.assertTrue(sm.join(.2))
+        self.assertEqual(tuple(regions), p.children)
+        self.assertTrue(Trace.contains([(r, 'entry') for r in regions]))
+
+
+class TestCompiled(unittest.TestCase):
+    def setUp(self):
+        Trace.clear()
+
+    def build(self):
+        c = State('c')
+        s1, s4 = State('s1'), State('s4')
+        s2 = State('s2', parent=c, initial=True)
+        s3 = State('s3', parent=c)
+        s1 >> 'a' >> s2 >> 'b' >> s3 >> 'c' >> s4
+        s2 >> 'd' >> s4
+        trace((s1, s2, s3, s4, c))
+        return StateMachine(s1, c, s4), (s1, s2, s4)
+
+    def test_paths(self):
+        '''The exit/entry paths of Transitions are computed when the
+           graph is compiled.'''
+        sm, (s1, s2, s4) = self.build()
+        c = s2.parent
+        sm.freeze()
+        compiled = sm._compiled
+        root = sm._cstate
+        self.assertEqual(([s2, c, root], [root, s4]), compiled.paths[(s2, s4)])
+
+        def lca(compiled, a, b):
+            self.fail('Paths computed while processing events')
+        sm.start()
+        sm.settle(.1)
+        orig_lca = CompiledGraph._lca
+        CompiledGraph._lca = lca
+        try:
+            sm.post('a', 'd')
+            sm.settle(.1)
+        finally:
+            sm.stop()
+            CompiledGraph._lca = orig_lca
+        self.assertTrue(sm.join(.2))
+        self.assertTrue(Trace.contains([(s1, 'exit'), (s2, 'entry'),
+                                        (s2, 'exit'), (s4, 'entry')]))
+
+    def test_unreachable_target(self):
+        '''Transitions to States outside the graph are reported.'''
+        s1, s2 = State('s1'), State('s2')
+        s1 >> 'a' >> State('outside')
+        sm = StateMachine(s1, s2)
+        with self.assertRaises(IllFormedException) as cm:
+            sm.start()
+        self.assertIn('{State-s1}-[a]->{State-outside} targets '
+                      '{State-outside}', str(cm.exception))
+        self.assertFalse(s1._frozen)
+
+    def test_shared(self):
+        '''StateMachines using the same graph share its tables.'''
+        class C(StateMachine):
+            i = InitialState()
+            s1 = State()
+            s2 = FinalState()
+            i >> s1 >> 'a' >> s2
+
+        sm1, sm2 = C(), C()
+        sm1.freeze()
+        sm2.freeze()
+        self.assertIs(sm1._compiled, sm2._compiled)
+        self.assertIs(sm1._interest, sm2._interest)
+        self.assertFalse(any(hasattr(s, '_depth')
+                             for s in sm1._compiled.states))
+        for sm in (sm1, sm2):
+            sm.start()
+            sm.post('a')
+            self.assertTrue(sm.join(1))
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_import(self):
+        '''Importing toysm doesn't import the modules only needed by
+           graph rendering, the scheduler or StateMachine.freeze.'''
+        lazy = ['subprocess', 'sched', 'six', 'hashlib', 'tempfile',
+                'toysm.graph', 'toysm.compiled']
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        out = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys; sys.path.insert(0, %r); import toysm; '
+             'print(sorted(m for m in %r if m in sys.modules))'
+             % (root, lazy)])
+        self.assertEqual(b'[]', out.strip())
+
+
+class TestGraph(unittest.TestCase):
+    FAKE_DOT = ('''import sys\n'''
+                '''args = sys.argv[2:]\n'''
+                '''data = sys.stdin.read()\n'''
+                '''with open(args[args.index('-o') + 1], 'w') as f:\n'''
+                '''    f.write(data)\n'''
+                '''with open(sys.argv[1], 'a') as f:\n'''
+                '''    f.write('x')\n''')
+
+    def build(self, desc='a'):
+        s1, s2 = State('s1'), State('s2')
+        p = ParallelState('p')
+        State('r1', State('s3') >> 'c' >> State('s4'), parent=p)
+        State('r2', parent=p).add_state(State('s5'), initial=True)
+        s1 >> desc >> s2 >> 'b' >> p
+        return StateMachine(s1, s2, p)
+
+    def test_to_dot(self):
+        '''The dot text doesn't depend on the objects' ids.'''
+        dot = self.build().to_dot()
+        self.assertEqual(dot, self.build().to_dot(dot='rankdir=LR'
+                                                  ).replace('rankdir=LR\n', ''))
+        self.assertEqual(dot.count('{'), dot.count('}'))
+        self.assertEqual(4, dot.count('subgraph'))
+        # s1->s2, s2->p, s3->s4 and the implicit initial transitions
+        # of the top-level State, r1 and r2
+        self.assertEqual(6, dot.count('->'))
+        f = io.StringIO()
+        self.assertIsNone(self.build().to_dot(f))
+        self.assertEqual(dot, f.getvalue())
+
+    def test_level_of_detail(self):
+        sm = self.build()
+        s1 = sm._cstate.initial
+        p = [c for c in sm._cstate.children if c.name == 'p'][0]
+        # p collapsed, s3 -> s4 is hidden
+        dot = sm.to_dot(max_depth=1)
+        self.assertEqual(1, dot.count('subgraph'))
+        self.assertEqual(3, dot.count('->'))
+        self.assertEqual(1, dot.count('peripheries'))
+        self.assertNotIn('label="s3"', dot)
+        # p and its regions only
+        dot = sm.to_dot(root=p)
+        self.assertEqual(3, dot.count('subgraph'))
+        self.assertEqual(3, dot.count('->'))
+        self.assertNotIn('label="s1"', dot)
+        # s1 and s2
+        dot = sm.to_dot(focus=s1)
+        self.assertEqual(2, dot.count('->'))
+        self.assertNotIn('label="p"', dot)
+        # ... and p, without its substates
+        dot = sm.to_dot(focus=s1, radius=2)
+        self.assertEqual(3, dot.count('->'))
+        self.assertIn('label="p"', dot)
+        self.assertNotIn('label="s3"', dot)
+
+    def test_render_cache(self):
+        '''Graphs are only rendered if they aren't in the cache.'''
+        import toysm.graph
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        script, log = os.path.join(tmp, 'dot.py'), os.path.join(tmp, 'log')
+        with open(script, 'w') as f:
+            f.write(self.FAKE_DOT)
+        orig_dot = toysm.graph.DOT
+        toysm.graph.DOT = '"%s" "%s" "%s"' % (sys.executable, script, log)
+        self.addCleanup(setattr, toysm.graph, 'DOT', orig_dot)
+
+        def render(sm):
+            fname = os.path.join(tmp, 'out.svg')
+            sm.graph(fname, cache_dir=os.path.join(tmp, 'cache'))
+            with open(fname) as f:
+                self.assertEqual(sm.to_dot(), f.read())
+            with open(log) as f:
+                return len(f.read())
+
+        self.assertEqual(1, render(self.build()))
+        self.assertEqual(1, render(self.build()))
+        self.assertEqual(2, render(self.build('d')))
+
+    def test_heat(self):
+        '''Number of instances in which States are active, overlaid on
+           the graph.'''
+        counts = []
+        for index in (False, True):
+            s11 = State('s11')
+            s1 = State('s1', s11 >> 'a' >> State('s12'))
+            s2 = State('s2')
+            sm = StateMachine(s1 >> 'b' >> s2,
+                              demux=lambda event: event, index=index)
+            sm.start()
+            sm.post(*[(k, 'x') for k in range(3)] + [(3, 'a'), (4, 'b')])
+            sm.settle(.1)
+            heat = sm.active_counts()
+            self.assertEqual(5, heat[sm._cstate])
+            self.assertEqual(4, heat[s1])
+            self.assertEqual(3, heat[s11])
+            self.assertEqual(1, heat[s2])
+            counts.append(sorted(heat.values()))
+            dot = sm.to_dot(heat=True)
+            self.assertIn(r'label="s1\n4"', dot)
+            self.assertIn(r'label="s2\n1"', dot)
+            # the top-level State, s1, s11, s12 and s2
+            self.assertEqual(5, dot.count('fillcolor="0.000 '))
+            sm.stop()
+            self.assertTrue(sm.join(.2))
+        self.assertEqual(counts[0], counts[1])
+        # counts given by the caller
+        sm = self.build()
+        dot = sm.to_dot(heat={sm._cstate.initial: 2})
+        self.assertIn(r'label="s1\n2"', dot)
+        self.assertIn('fillcolor="0.000 1.000 1.000"', dot)
+
+
+class TestLargeGraphs(unittest.TestCase):
+    '''Graph algorithms on generated graphs of 100k States.'''
+    N = 100000
+
+    def nested(self, n=N):
+        '''Returns a StateMachine with n nested States and its deepest
+           State.'''
+        root = state = State('root')
+        for _ in range(n):
+            state = State(parent=state, initial=True)
+        return StateMachine(root), state
+
+    def test_lca(self):
+        sm, leaf = self.nested()
+        root = sm._cstate
+        other = State('other', parent=root)
+        sm.freeze()
+        compiled = sm._compiled
+        self.assertEqual(self.N, compiled.depth[compiled.ids[leaf]])
+        a_path, b_path = compiled.lca(leaf, other)
+        self.assertEqual(self.N + 1, len(a_path))
+        self.assertIs(root, a_path[-1])
+        self.assertEqual([root, other], b_path)
+
+    def test_active_states(self):
+        sm, leaf = self.nested()
+        sm_state = SMState(sm)
+        state = leaf
+        while state.parent is not None:
+            sm_state.retrieve_state(state.parent).active_substate = state
+            state = state.parent
+        active = [s for (s, _) in sm._cstate.get_active_states(sm_state)]
+        self.assertEqual(self.N + 1, len(active))
+        self.assertIs(leaf, active[-1])
+
+    def test_graph(self):
+        # Smaller graph: writing the attributes of each State dominates,
+        # what matters is that endpoints of edges to clusters are found
+        # in linear time.
+        n = self.N // 5
+        sm, _ = self.nested(n)
+        dot = sm.to_dot()
+        self.assertEqual(n, dot.count('subgraph'))
+        self.assertEqual(n, dot.count('->'))
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -26,8 +26,9 @@ import unittest
 
 from toysm import *
 from toysm.base_sm import (mask_states, mask_transitions,
-                           BadSMDefinition,
+                           BadSMDefinition, SMMeta,
                            on_enter, on_exit, trigger, action)
+from toysm.recorder import FlightRecorder
 from sm_trace import Trace, trace
 
 import logging
@@ -132,6 +133,97 @@ class TestInheritance(unittest.TestCase):
         self.assertEqual(len(C._transitions) - 1, len(D._transitions))
         self.assertSetEqual({'t_s1_b'}, set(D._transitions.keys()))
 
+    def test_ignore_states_references(self):
+        """Masks still apply to States copied after references to the
+           superclass' States."""
+        class C(StateMachine):
+            i = InitialState()
+            s1 = State()
+            s2 = State()
+            s3 = State()
+
+            i >> s1 >> 'a' >> s2 >> 'b' >> s3
+
+        class D(C):
+            mask_states('s3')
+            s4 = State()
+            C.s1 >> 'c' >> s4
+            C.s2 >> 'd' >> s4
+
+        self.assertSetEqual({'i', 's1', 's2', 's4'}, set(D._states.keys()))
+        self.assertEqual(['a', 'c'], sorted(t.desc for t in
+                                            D._states['s1'].transitions))
+        self.assertEqual(['d'], [t.desc for t in D._states['s2'].transitions])
+
+    def test_large_graph(self):
+        """Copy of a StateMachine with a chain of 100k States."""
+        n = 100000
+        states = [State('s%i' % i) for i in range(n)]
+        for a, b in zip(states, states[1:]):
+            a >> 'n' >> b
+        init = InitialState()
+        init >> states[0]
+        C = SMMeta('C', (StateMachine,), {'s0': states[0], 'init': init})
+        D = SMMeta('D', (C,), {'extra': State()})
+        state, count = D._states['s0'], 1
+        while state.transitions:
+            self.assertIsNot(states[count - 1], state)
+            state = state.transitions[0].target
+            count += 1
+        self.assertEqual(n, count)
+        self.assertEqual(n + 2, len(D._cstate.children))
+
+    def test_shared_graph(self):
+        """Subclasses that don't alter their base's graph share it."""
+        class C(StateMachine):
+            i = InitialState()
+            s1 = State()
+            s2 = FinalState()
+            i >> s1 >> 'a' >> s2
+
+        class D(C):
+            pass
+
+        class E(D):
+            def helper(self):
+                pass
+
+        class F(C):
+            @on_enter(C.s1)
+            def s1_enter(sm, state):
+                pass
+
+        class G(C):
+            mask_states('s2')
+
+        self.assertIs(C._cstate, D._cstate)
+        self.assertIs(C._cstate, E._cstate)
+        self.assertIs(C._states, E._states)
+        self.assertIsNot(C._cstate, F._cstate)
+        self.assertIsNot(C.s1, F.s1)
+        self.assertIsNot(C._cstate, G._cstate)
+
+        # The shared graph is read-only
+        self.assertRaises(IllFormedException, C._cstate.add_hook, 'entry',
+                          lambda sm, state: None)
+
+        # Instances of the class and its subclass run independently, a
+        # recorder attached to one of them doesn't see the other.
+        c, e = C(), E()
+        recorder = FlightRecorder().attach(e)
+        exits = []
+        for sm in (c, e):
+            sm.add_state_hook(C._states['s1'], 'exit',
+                              lambda sm, state: exits.append(sm))
+            sm.start()
+            sm.post('a')
+            self.assertTrue(sm.join(1))
+        self.assertEqual([c._sm_state, e._sm_state], exits)
+        self.assertEqual({None}, {k for (_, _, _, _, k)
+                                  in recorder.records()})
+        self.assertEqual(1, sum(1 for (_, _, _, evt, _)
+                                in recorder.records() if evt == 'a'))
+
     def test_ignore_transitions(self):
         class C(StateMachine):
             i = InitialState()
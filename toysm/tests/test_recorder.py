@@ -0,0 +1,154 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from toysm import *
+from toysm.recorder import FlightRecorder, _Ring
+
+
+class TestFlightRecorder(unittest.TestCase):
+    def test_ring(self):
+        ring = _Ring(4)
+        for i in range(6):
+            ring.append(float(i), 0, i, None, None)
+        self.assertEqual([2, 3, 4, 5], [r[2] for r in ring])
+
+    def test_records(self):
+        s1 = State('s1')
+        s2 = State('s2')
+        fs = FinalState()
+        t = EqualsTransition('a')
+        t2 = EqualsTransition('b')
+        sm = StateMachine(s1 >> t >> s2 >> t2 >> fs)
+        rec = FlightRecorder(size=64).attach(sm)
+        small_rec = FlightRecorder(size=3).attach(sm)
+
+        sm.start()
+        sm.post('a', 'b')
+        self.assertTrue(sm.join(1))
+
+        self.assertIn(('action', t, 'a'),
+                      [(kind, elt, evt) for (_, kind, elt, evt, _)
+                       in rec.records()])
+        self.assertEqual([(s1, 'entry'), (s1, 'exit'), (t, 'action'),
+                          (s2, 'entry')],
+                         [(elt, kind) for (_, kind, elt, _, _)
+                          in rec.records() if elt in (s1, s2, t)][:4])
+        # Only the last 3 records are kept
+        self.assertEqual([(t2, 'action'), (fs, 'entry'), (sm._cstate, 'exit')],
+                         [(elt, kind) for (_, kind, elt, _, _)
+                          in small_rec.records()])
+
+    def test_per_instance(self):
+        s1 = State('s1')
+        s2 = State('s2')
+        sm = StateMachine(s1 >> 'a' >> s2 >> 'b' >> FinalState(),
+                          demux=lambda event: (event[0], event[1]))
+        rec = FlightRecorder(size=8, per_instance=True).attach(sm)
+        sm.start()
+        sm.post((1, 'a'), (2, 'a'), (2, 'b'))
+        self.assertTrue(sm.settle(.1))
+        self.assertEqual([(s1, 'entry'), (s1, 'exit'), (s2, 'entry')],
+                         [(elt, kind) for (_, kind, elt, _, _)
+                          in rec.records(key=1) if elt in (s1, s2)])
+        # Instance 2 completed, its records were released
+        self.assertEqual([], rec.records(key=2))
+        sm.stop()
+        self.assertTrue(sm.join(1))
+
+    def test_dump_on_error(self):
+        def fail(sm, evt):
+            raise ValueError('failed')
+        s1 = State('s1')
+        out = StringIO()
+        sm = StateMachine(s1 >> EqualsTransition('a', action=fail)
+                          >> State('s2'))
+        FlightRecorder(stream=out).attach(sm)
+        sm.start()
+        sm.post('a')
+        self.assertTrue(sm.join(1))
+        self.assertIn("raised while processing 'a'", out.getvalue())
+        self.assertIn("action {State-s1}-[a]->{State-s2} evt='a'",
+                      out.getvalue())
+
+    def test_attach_after_start(self):
+        '''Recorders can be attached to instances of a StateMachine class
+           once another one is started, and only record their own
+           instance.'''
+        class C(StateMachine):
+            i = InitialState()
+            s1 = State()
+            s2 = State()
+            i >> s1 >> 'a' >> s2
+
+        sm1 = C()
+        sm1.start()
+        sm2 = C()
+        recorder = FlightRecorder().attach(sm2)
+        sm2.start()
+        sm1.post('a')
+        sm2.post('a')
+        for sm in (sm1, sm2):
+            sm.settle(.1)
+            sm.stop()
+            self.assertTrue(sm.join(1))
+        records = recorder.records()
+        self.assertEqual(['exit', 'action', 'entry'],
+                         [kind for (_, kind, _, _, _) in records[-3:]])
+        self.assertEqual(1, sum(1 for (_, _, _, evt, _) in records
+                                if evt == 'a'))
+        # sm1 isn't recorded, even when restarted
+        sm1.start()
+        sm1.stop()
+        self.assertTrue(sm1.join(1))
+        self.assertEqual(records, recorder.records())
+
+    def test_dump_on_error_tuple_key(self):
+        '''Instances with non-integer keys (e.g. flows) are dumped.'''
+        def fail(sm, evt):
+            raise ValueError('failed')
+        s1 = State('s1')
+        out = StringIO()
+        sm = StateMachine(s1 >> EqualsTransition('a', action=fail)
+                          >> State('s2'), demux=lambda event: event)
+        FlightRecorder(stream=out).attach(sm)
+        sm.start()
+        key = ('10.0.0.1', 80)
+        sm.post((key, 'a'))
+        sm.settle(.1)
+        sm.stop()
+        self.assertTrue(sm.join(1))
+        self.assertIn("key=('10.0.0.1', 80) - ValueError", out.getvalue())
+        self.assertIn("action {State-s1}-[a]->{State-s2} evt='a'",
+                      out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab:sw=4:sts=4
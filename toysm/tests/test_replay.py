@@ -0,0 +1,85 @@
+################################################################################
+#
+# Copyright 2016 William Barsse
+#
+################################################################################
+#
+# This file is part of ToySM.
+#
+# ToySM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ToySM Extensions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ToySM.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import io
+import os
+import tempfile
+import unittest
+
+from toysm import *
+from toysm import replay
+
+
+class ReplaySM(StateMachine):
+    i = InitialState()
+    s1 = State()
+    s2 = State()
+    i >> s1 >> 'a' >> s2 >> 'b' >> s1
+
+
+class TestReplay(unittest.TestCase):
+    records = [(0., None, 'a'), (.01, None, 'b'), (.02, None, 'a')]
+
+    def roundtrip(self, records, binary):
+        stream = io.BytesIO()
+        replay.write_records(stream, records, binary=binary)
+        stream.seek(0)
+        return list(replay.read_records(stream))
+
+    def test_formats(self):
+        records = self.records + [(None, 3, [1, 'x'])]
+        for binary in (False, True):
+            self.assertEqual(
+                [tuple(r) for r in records],
+                [tuple(r) for r in self.roundtrip(records, binary)])
+
+    def test_load_object(self):
+        self.assertIs(ReplaySM,
+                      replay.load_object(__name__ + '.ReplaySM'))
+        self.assertIs(ReplaySM.s1,
+                      replay.load_object(__name__ + ':ReplaySM.s1'))
+
+    def test_replay(self):
+        res = replay.replay(replay.make_sm(ReplaySM), self.records,
+                            pace=True)
+        self.assertEqual(3, res['events'])
+        self.assertTrue(res['duration'] >= .02)
+        self.assertTrue(res['latency_p50_us'] <= res['latency_max_us'])
+
+    def test_main_demux(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                replay.write_records(f, [(None, k, e) for k in range(10)
+                                         for e in 'ab'], binary=True)
+            self.assertEqual(0, replay.main([__name__ + '.ReplaySM', path,
+                                             '--json']))
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab:sw=4:sts=4